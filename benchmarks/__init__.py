@@ -0,0 +1,7 @@
+"""
+    Benchmarks of pysorter on reproducible synthetic directory trees, run with
+
+        python -m benchmarks --files 100000
+
+    from the root of the repository. See `python -m benchmarks --help`.
+"""
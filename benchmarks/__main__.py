@@ -0,0 +1,72 @@
+"""
+    Times organizing a generated tree, see benchmarks.tree, and reports the
+    paths per second and the peak resident memory of each case, see
+    benchmarks.cases.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+from .cases import CASES, DEFAULT_RULES, run
+
+
+def format_results(results):
+    lines = ['{:<16} {:>10} {:>10} {:>12} {:>14}'.format(
+        'case', 'paths', 'seconds', 'paths/s', 'peak RSS (MiB)')]
+    for result in results:
+        rss = result['peak_rss']
+        lines.append('{:<16} {:>10} {:>10.3f} {:>12.0f} {:>14}'.format(
+            result['case'], result['paths'], result['seconds'], result['paths_per_second'] or 0,
+            '{:.1f}'.format(rss / 2.0 ** 20) if rss is not None else '-'))
+    return '\n'.join(lines)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    parser.add_argument('cases', nargs='*', default=list(CASES),
+                        help='cases to run, all by default')
+    parser.add_argument('--files', type=int, default=10000, help='number of files in the tree')
+    parser.add_argument('--depth', type=int, default=3, help='depth of the directories')
+    parser.add_argument('--fanout', type=int, default=4, help='subdirectories per directory')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated tree')
+    parser.add_argument('--collisions', type=float, default=0.05,
+                        help='share of files with a common name')
+    parser.add_argument('--empty-dirs', dest='empty_dirs', type=float, default=0.02,
+                        help='share of directories with an empty subdirectory')
+    parser.add_argument('--unknown', type=float, default=0.05,
+                        help='share of files no rule knows the extension of')
+    parser.add_argument('--rules', default=DEFAULT_RULES, help='the rules file to organize with')
+    parser.add_argument('--workdir', help='directory to generate trees in, temporary by default')
+    parser.add_argument('--json', dest='json_path', help='also write the results to this file')
+    args = parser.parse_args(args)
+    for name in args.cases:
+        if name not in CASES:
+            parser.error("unknown case: {} (choose from {})".format(name, ', '.join(CASES)))
+    return args
+
+
+def main(args=None):
+    args = parse_args(args)
+    tree_options = dict(files=args.files, depth=args.depth, fanout=args.fanout, seed=args.seed,
+                        collisions=args.collisions, empty_dirs=args.empty_dirs,
+                        unknown=args.unknown)
+
+    workdir = tempfile.mkdtemp(prefix='pysorter-bench-', dir=args.workdir)
+    try:
+        results = run(args.cases, os.path.abspath(args.rules), workdir, tree_options)
+    finally:
+        shutil.rmtree(workdir)
+
+    print(format_results(results))
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'tree': tree_options, 'results': results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
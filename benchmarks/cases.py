@@ -0,0 +1,133 @@
+"""
+    The cases that the benchmarks time, each run in a process of its own,
+    so that its peak resident memory is its own
+"""
+from __future__ import print_function
+
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import redirect_stdout
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+import pysorter
+from pysorter import filesystem as fs
+from pysorter.oranize import Organizer
+from pysorter.rules import RulesFileClassifier, Skip, SkipRecurse, Unhandled
+
+from .tree import generate_tree
+
+DEFAULT_RULES = os.path.join(os.path.dirname(pysorter.__file__), 'filetypes.py')
+
+
+def organizer(source, classifier, **kwargs):
+    return Organizer(source, classifier, do_recurse=True, do_remove_empty_dirs=True, **kwargs)
+
+
+def dry_run(source, scratch, classifier):
+    return organizer(source, classifier, dry_run=True).organize
+
+
+def in_place(source, scratch, classifier):
+    return organizer(source, classifier).organize
+
+
+def cross_directory(source, scratch, classifier):
+    return organizer(source, classifier, dest_dir=os.path.join(scratch, 'out')).organize
+
+
+def classify(source, scratch, classifier):
+    paths = [path for path, _ in fs.scan_tree(source, recurse=True)]
+
+    def run():
+        for path in paths:
+            try:
+                classifier.destination(path)
+            except (Unhandled, Skip, SkipRecurse):
+                pass
+    return run
+
+
+def empty_dirs(source, scratch, classifier):
+    sorter = organizer(source, classifier, dry_run=True)
+    sorter.do_remove_empty_dirs = False
+    sorter.organize()
+    move_tuples = sorter.dry_mv_tuples
+    return lambda: fs.collect_terminal_empty_dirs(source, move_tuples)
+
+
+# name --> (function(source, scratch, classifier) --> function to time,
+#           does it change the tree?)
+CASES = OrderedDict([
+    ('dry-run', (dry_run, False)),
+    ('in-place', (in_place, True)),
+    ('cross-directory', (cross_directory, True)),
+    ('classify', (classify, False)),
+    ('empty-dirs', (empty_dirs, False)),
+])
+
+
+def peak_rss():
+    """Return the peak resident memory of this process in bytes, or None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(name, rules_path, source, paths, scratch, tree_options):
+    """
+    Time the case `name` on the tree in `source` with `paths` paths,
+    or on a new tree in `scratch` if the case changes it.
+    """
+    function, mutates = CASES[name]
+    if mutates:
+        source = os.path.join(scratch, 'src')
+        paths = generate_tree(source, **tree_options)
+
+    classifier = RulesFileClassifier.load_file(rules_path)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        timed = function(source, scratch, classifier)
+        start = time.perf_counter()
+        timed()
+        seconds = time.perf_counter() - start
+
+    return OrderedDict([
+        ('case', name),
+        ('paths', paths),
+        ('seconds', seconds),
+        ('paths_per_second', paths / seconds if seconds else None),
+        ('peak_rss', peak_rss()),
+    ])
+
+
+def _initialize_worker():
+    # conflicts between colliding names are expected
+    logging.basicConfig(level=logging.ERROR)
+
+
+def run(cases, rules_path, workdir, tree_options):
+    """Return the results of the `cases`, run one after another in `workdir`"""
+    tree = os.path.join(workdir, 'tree')
+    paths = None
+    if not all(CASES[name][1] for name in cases):
+        paths = generate_tree(tree, **tree_options)
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in cases:
+        scratch = tempfile.mkdtemp(prefix=name + '-', dir=workdir)
+        with context.Pool(1, initializer=_initialize_worker) as pool:
+            results.append(pool.apply(run_case, (name, rules_path, tree, paths, scratch, tree_options)))
+        shutil.rmtree(scratch)
+    return results
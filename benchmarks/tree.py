@@ -0,0 +1,119 @@
+"""
+    Generates reproducible directory trees of empty files to organize
+"""
+from __future__ import print_function
+
+import os
+import random
+from itertools import accumulate
+
+from pysorter import filetypes, rules
+
+# extensions that no default rule knows, and files without one
+UNKNOWN_EXTENSIONS = ['.unknownext', '.tmp0', '']
+
+# number of base names that colliding files share
+COLLIDING_NAMES = 16
+
+
+def rule_extensions():
+    """
+    Return the extensions that the default rules of filetypes.RULES sort by,
+    in the order of the rules.
+    """
+    extensions = []
+    seen = set()
+    for regex, _ in filetypes.RULES:
+        suffix = rules.literal_suffix(regex)
+        if suffix is None or not rules.is_extension(suffix[0]):
+            continue
+        extension = suffix[0]
+        if extension not in seen:
+            seen.add(extension)
+            extensions.append(extension)
+    return extensions
+
+
+def directory_paths(depth, fanout):
+    """
+    Return the canonical paths of the directories of a tree `depth` levels
+    deep, with `fanout` subdirectories each, breadth first, starting with ''.
+    """
+    paths = ['']
+    level = ['']
+    for _ in range(depth):
+        level = ['{}d{}/'.format(parent, i) for parent in level for i in range(fanout)]
+        paths.extend(level)
+    return paths
+
+
+def generate_tree(root, files=1000, depth=3, fanout=4, seed=0,
+                  collisions=0.05, empty_dirs=0.02, unknown=0.05):
+    """
+    Create a tree of empty files in the directory `root`, which is the same
+    for the same arguments, and return the number of paths in it.
+
+    Parameters
+    ----------
+    files: int
+        number of files, spread evenly over the directories
+
+    depth, fanout: int
+        the directories, see `directory_paths`
+
+    seed: int
+        seed of the random choices
+
+    collisions: float
+        share of files named after one of a few common names, so that
+        files from different directories end up at the same destination
+
+    empty_dirs: float
+        share of directories that get an empty subdirectory, half of which
+        hold another empty directory in turn
+
+    unknown: float
+        share of files with an extension that no default rule knows,
+        the extensions of all others are drawn from the default rules,
+        with the earlier rules more likely
+    """
+    rng = random.Random(seed)
+    extensions = rule_extensions()
+    cum_weights = list(accumulate(1.0 / rank for rank in range(1, len(extensions) + 1)))
+
+    dirs = directory_paths(depth, fanout)
+    per_dir, remainder = divmod(files, len(dirs))
+
+    paths = 0
+    number = 0
+    for i, path in enumerate(dirs):
+        directory = os.path.join(root, path)
+        os.makedirs(directory, exist_ok=True)
+        paths += 1
+
+        for _ in range(per_dir + (i < remainder)):
+            if rng.random() < unknown:
+                extension = rng.choice(UNKNOWN_EXTENSIONS)
+            else:
+                extension = rng.choices(extensions, cum_weights=cum_weights)[0]
+
+            if rng.random() < collisions:
+                name = 'common{}{}'.format(rng.randrange(COLLIDING_NAMES), extension)
+                if os.path.lexists(os.path.join(directory, name)):
+                    name = 'file{}{}'.format(number, extension)
+            else:
+                name = 'file{}{}'.format(number, extension)
+            number += 1
+
+            os.close(os.open(os.path.join(directory, name), os.O_CREAT | os.O_WRONLY, 0o644))
+            paths += 1
+
+        if rng.random() < empty_dirs:
+            empty = os.path.join(directory, 'empty{}'.format(i))
+            os.mkdir(empty)
+            paths += 1
+            if rng.random() < 0.5:
+                os.mkdir(os.path.join(empty, 'inner'))
+                paths += 1
+
+    return paths
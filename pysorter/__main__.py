@@ -1,4 +1,6 @@
 
 if __name__ == '__main__':
+    import sys
+
     from . import commandline
-    commandline.main()
+    sys.exit(commandline.main())
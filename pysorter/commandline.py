@@ -9,9 +9,14 @@ import logging
 import os
 import sys
 
+from .filesystem import LINK_MODES
+from .journal import Journal, pending_operations
 from .oranize import Organizer
+from .plan import MovePlan
 
-from .rules import RulesFileClassifier
+from .rules import AdaptiveClassifier, CachingClassifier, ProfilingClassifier, RulesFileClassifier
+from .state import StateIndex, rules_key
+from .watch import watch
 
 log = logging.getLogger(__name__)
 
@@ -42,6 +47,26 @@ def validate_arguments(args):
     if args.unhandled_file:
         args.unhandled_file = os.path.abspath(args.unhandled_file)
 
+    if args.profile_rules and args.adapt_rules:
+        raise ValueError("--profile-rules and --adapt-rules cannot be used together")
+
+    if args.save_plan and args.apply_plan:
+        raise ValueError("--save-plan and --apply-plan cannot be used together")
+
+    if args.journal:
+        args.journal = os.path.abspath(args.journal)
+    elif args.resume:
+        raise ValueError("--resume requires a --journal")
+
+    if args.state:
+        args.state = os.path.abspath(args.state)
+
+    if args.watch and (args.save_plan or args.apply_plan or args.resume):
+        raise ValueError("--watch cannot be used with --save-plan, --apply-plan or --resume")
+
+    if args.apply_plan and not os.path.isfile(args.apply_plan):
+        raise OSError("Plan is not a file or does not exist: {}".format(args.apply_plan))
+
     return args
 
 
@@ -101,6 +126,13 @@ def parse_args(args=None):
         dest="do_remove_empty_dirs",
     )
 
+    parser.add_argument(
+        "--only-emptied",
+        help="With -c, only remove the directories that organizing emptied, instead of walking the directory again",
+        action="store_true",
+        dest="remove_only_emptied",
+    )
+
     parser.add_argument(
         "-n",
         "--dry-run",
@@ -109,6 +141,144 @@ def parse_args(args=None):
         dest="dry_run",
     )
 
+    parser.add_argument(
+        "--link-mode",
+        help="Move entries to their destination, or leave them and place links or reflinked copies there [Default: move]",
+        choices=LINK_MODES,
+        default="move",
+        dest="link_mode",
+    )
+
+    parser.add_argument(
+        "--coalesce-dirs",
+        help="Move a directory as a whole when all of its files go to the same new directory (with -c or a link mode)",
+        action="store_true",
+        dest="coalesce_dirs",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of threads used to move files [Default: 1]",
+        type=int,
+        default=1,
+        dest="jobs",
+    )
+
+    parser.add_argument(
+        "--classify-jobs",
+        help="Number of processes used to match files against the rules [Default: 1]",
+        type=int,
+        default=1,
+        dest="classify_jobs",
+    )
+
+    parser.add_argument(
+        "--prefilter-rules",
+        help="Skip regex rules whose required literal text is absent from a path.",
+        action="store_true",
+        dest="prefilter_rules",
+    )
+
+    parser.add_argument(
+        "--profile-rules",
+        help="Count the attempts, matches and time of every rule, write them as JSON to this file, "
+             "and print the most expensive rules. Disables the cache of --cache-size, "
+             "and rules applied by --classify-jobs workers are not counted",
+        dest="profile_rules",
+    )
+
+    parser.add_argument(
+        "--adapt-rules",
+        help="Search the rules that match most often first, where that cannot change which rule matches a path. "
+             "The order is learned over runs, and kept in a .order.json file next to the rules file",
+        action="store_true",
+        dest="adapt_rules",
+    )
+
+    parser.add_argument(
+        "--rules-cache",
+        help="Keep the loaded rules in this directory, so that later runs only read the rules file again when it changed",
+        dest="rules_cache",
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        help="Number of classification results to cache by file extension, 0 disables the cache [Default: 4096]",
+        type=int,
+        default=4096,
+        dest="cache_size",
+    )
+
+    parser.add_argument(
+        "--index-destinations",
+        help="Read each destination directory once to check for existing destinations, instead of checking every "
+             "path. Only dry runs and directory moves check their destinations beforehand",
+        action="store_true",
+        dest="index_destinations",
+    )
+
+    parser.add_argument(
+        "--save-plan",
+        help="Write the planned moves to this file instead of performing them",
+        dest="save_plan",
+    )
+
+    parser.add_argument(
+        "--apply-plan",
+        help="Perform the moves in this file, written by --save-plan, instead of matching rules",
+        dest="apply_plan",
+    )
+
+    parser.add_argument(
+        "--journal",
+        help="Record planned and completed moves in this file, so that an interrupted run can be resumed",
+        dest="journal",
+    )
+
+    parser.add_argument(
+        "--resume",
+        help="Finish the moves recorded in the journal of an interrupted run",
+        action="store_true",
+        dest="resume",
+    )
+
+    parser.add_argument(
+        "--state",
+        help="Keep an index of organized directories in this file, and skip those that did not change on later runs",
+        dest="state",
+    )
+
+    parser.add_argument(
+        "--watch",
+        help="Keep running, and organize entries as they are added to the directory",
+        action="store_true",
+        dest="watch",
+    )
+
+    parser.add_argument(
+        "--settle-time",
+        help="Seconds an entry must go unchanged before it is organized with --watch [Default: 2]",
+        type=float,
+        default=2.0,
+        dest="settle_time",
+    )
+
+    parser.add_argument(
+        "--poll-interval",
+        help="With --watch, look for changes every this many seconds instead of using inotify",
+        type=float,
+        default=None,
+        dest="poll_interval",
+    )
+
+    parser.add_argument(
+        "--stats",
+        help="Print the number of paths seen, moved, skipped, unhandled and conflicted, and the time spent in each phase",
+        action="store_true",
+        dest="stats",
+    )
+
     parser.add_argument(
         "-V",
         "--version",
@@ -120,13 +290,69 @@ def parse_args(args=None):
     return validate_arguments(parser.parse_args(args))
 
 
+def organize_with_journal(sorter, journal, resume=False):
+    """
+    Organize with a journal of the planned and completed moves, or when
+    resuming, finish the moves that the journal does not record as completed.
+    """
+    plan = None
+    if os.path.exists(journal.path):
+        plan, done, finished = journal.read()
+        if plan is not None and not finished and not resume:
+            msg = "An interrupted run left a journal, use --resume to finish it: {}"
+            raise RuntimeError(msg.format(journal.path))
+        if plan is not None and finished and resume:
+            log.info("Nothing to resume, the journaled run finished: %s", journal.path)
+            return
+
+    if resume and plan is not None:
+        if plan.source != sorter.path_source:
+            raise ValueError("Journal was made for another directory: {}".format(plan.source))
+        pending = pending_operations(plan, done)
+        log.info("Resuming %d of %d moves", len(pending), len(plan))
+        journal.reopen()
+        try:
+            sorter.apply(plan.subset(pending), done=lambda i: journal.mark_done(pending[i]))
+        finally:
+            journal.close()
+    else:
+        plan = sorter.plan()
+        journal.start(plan)
+        try:
+            sorter.apply(plan, done=journal.mark_done)
+        finally:
+            journal.close()
+        sorter.save_state()
+
+    if not sorter.failed:
+        journal.reopen()
+        journal.finish()
+
+
 def main(args=None):
     global _last_sorter
 
     logging.basicConfig()
     args = parse_args(args)
 
-    rules = RulesFileClassifier.load_file(args.filetypes)
+    rules = None
+    profiled = None
+    adaptive = None
+    if not args.apply_plan:
+        classifier = RulesFileClassifier
+        if args.profile_rules:
+            classifier = ProfilingClassifier
+        elif args.adapt_rules:
+            classifier = AdaptiveClassifier
+        rules = classifier.load_file(args.filetypes, prefilter=args.prefilter_rules,
+                                     cache_dir=args.rules_cache)
+        if args.profile_rules:
+            profiled = rules
+        elif args.adapt_rules:
+            adaptive = rules
+        # cached paths would not reach the rules that are profiled
+        if args.cache_size > 0 and not args.profile_rules:
+            rules = CachingClassifier(rules, maxsize=args.cache_size)
 
     topass = dict(vars(args))
 
@@ -134,20 +360,71 @@ def main(args=None):
     del topass["directory"]
     del topass["filetypes"]
     del topass["unhandled_file"]
+    del topass["prefilter_rules"]
+    del topass["profile_rules"]
+    del topass["adapt_rules"]
+    del topass["rules_cache"]
+    del topass["cache_size"]
+    del topass["save_plan"]
+    del topass["apply_plan"]
+    del topass["journal"]
+    del topass["resume"]
+    del topass["watch"]
+    del topass["settle_time"]
+    del topass["poll_interval"]
+
+    if args.state:
+        key = rules_key(args.filetypes, os.path.abspath(args.directory),
+                        os.path.abspath(args.dest_dir or args.directory),
+                        args.do_recurse, args.do_process_dirs, args.link_mode)
+        topass["state"] = StateIndex(args.state, key)
 
     sorter = Organizer(args.directory, rules, **topass)
-    sorter.organize()
+
+    try:
+        if args.apply_plan:
+            plan = MovePlan.load(args.apply_plan)
+            if plan.source != sorter.path_source:
+                raise ValueError("Plan was made for another directory: {}".format(plan.source))
+            sorter.apply(plan)
+        elif args.save_plan:
+            sorter.plan().save(args.save_plan)
+        elif args.watch:
+            watch(sorter, quiet=args.settle_time, poll_interval=args.poll_interval)
+        elif args.journal and not args.dry_run:
+            organize_with_journal(sorter, Journal(args.journal), args.resume)
+        else:
+            sorter.organize()
+    finally:
+        sorter.close()
 
     # variable used for testing and debugging
     _last_sorter = sorter
 
+    if isinstance(rules, CachingClassifier):
+        log.debug("classification cache: %s", rules.info())
+
+    if adaptive is not None:
+        adaptive.save_order()
+
+    if profiled is not None:
+        with open(args.profile_rules, "w") as f:
+            f.write(profiled.profile_json())
+        print(profiled.format_profile(limit=20), file=sys.stderr)
+
+    if sorter.stats is not None:
+        print(sorter.stats.format(), file=sys.stderr)
+
+    if sorter.failed:
+        log.error("%d moves failed", len(sorter.failed))
+
     # write out all the unknown file types
     if args.unhandled_file:
         with open(args.unhandled_file, "a") as ufile:
             for i in sorter.unhandled_paths:
                 ufile.write(i)
                 ufile.write("\n")
-    return 0
+    return 1 if sorter.failed else 0
 
 
 if __name__ == "__main__":
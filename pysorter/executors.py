@@ -0,0 +1,288 @@
+"""
+    Executors that carry out the moves decided on by the organizer
+"""
+from __future__ import print_function
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import os
+
+from . import filesystem as fs
+from . import rules
+from .plan import FILE
+
+log = logging.getLogger(__name__)
+
+
+class DirectoryMaker(object):
+    """
+    Creates directories like fs.make_path, but only once: directories that
+    it made or found before are not checked again. It can be shared by
+    threads.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.made = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, path):
+        if path in self.made:
+            return
+        with self.lock:
+            if path not in self.made:
+                fs.make_path(path)
+                self.made.add(path)
+
+    def make_all(self, paths):
+        """
+        Create all directories `paths`, parents before their children. Those
+        that cannot be made are left to fail the moves into them.
+        """
+        for path in sorted(paths):
+            try:
+                self(path)
+            except OSError as e:
+                log.debug("cannot make %s: %s", path, e)
+
+
+class SerialMover(object):
+    """
+    Moves the files and directories of a MovePlan one after the other.
+    Errors are raised, rather than collected in `failed`.
+    """
+
+    def __init__(self, link_mode='move'):
+        super().__init__()
+        self.link_mode = link_mode
+        self.failed = []
+        self.make_path = DirectoryMaker()
+        self.copier = fs.CrossDeviceCopier()
+
+    def apply(self, plan, done=None):
+        """
+        Carry out all operations of `plan`, calling `done` with
+        the index of every operation once it is completed.
+        """
+        self.make_path.make_all(plan.destination_dirs())
+        try:
+            for index, (src, dst, kind) in enumerate(plan):
+                moved = move(src, dst, kind, make_path=self.make_path,
+                             copier=self.copier, link_mode=self.link_mode)
+                if moved and done is not None:
+                    done(index)
+        finally:
+            self.copier.close()
+
+
+def move(src, dst, kind, make_path=fs.make_path, copier=None, link_mode='move'):
+    """
+    Move `src` to `dst`, creating the directory of `dst` with `make_path`,
+    and copying to other filesystems with the CrossDeviceCopier `copier`.
+    With a `link_mode` other than 'move', `src` is linked to instead, see
+    fs.link_file. Returns False, rather than replacing it, if `dst` exists.
+    """
+    make_path(os.path.dirname(dst))
+    log.info("{} {} --> {}".format(link_mode, src, dst))
+    try:
+        if link_mode != 'move':
+            link = fs.link_file if kind == FILE else fs.link_dir
+            link(src, dst, link_mode, copier=copier)
+        elif kind == FILE:
+            fs.move_file(src, dst, copier=copier)
+        else:
+            fs.move_dir(src, dst, copier=copier)
+    except FileExistsError:
+        log.info("destination exists: `%s` --> `%s`", src, dst)
+        return False
+    return True
+
+
+class ThreadPoolMover(object):
+    """
+    Moves the files and directories of a MovePlan on a pool of worker threads,
+    which helps when every rename is a network round trip, e.g. on NFS or SMB
+    mounts. Conflicts were already ruled out when the plan was made.
+
+    Directories are moved once all moves before them have finished, and
+    before any move after them starts, as the plan may move files into a
+    directory before moving the directory itself.
+
+    Failed moves are logged and collected in `failed`, as (src, dst, error)
+    tuples, instead of aborting the remaining moves.
+    """
+
+    def __init__(self, jobs, max_pending=None, link_mode='move'):
+        """
+        Parameters
+        ----------
+        jobs: int
+            number of worker threads
+
+        max_pending: int
+            maximum number of moves that are submitted but not yet finished,
+            `submit` blocks while this many are in flight. Defaults to four
+            moves per worker.
+
+        link_mode: str
+            one of fs.LINK_MODES, see `move`
+        """
+        super().__init__()
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.max_pending = max_pending or 4 * jobs
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.link_mode = link_mode
+
+        self.failed = []
+        self.make_path = DirectoryMaker()
+        self.copier = fs.CrossDeviceCopier()
+
+    def apply(self, plan, done=None):
+        """
+        Carry out all operations of `plan`, calling `done` (from a worker
+        thread) with the index of every operation that succeeded.
+        """
+        self.make_path.make_all(plan.destination_dirs())
+        for index, (src, dst, kind) in enumerate(plan):
+            callback = lambda index=index: done(index) if done else None
+            if kind == FILE:
+                self.submit(src, dst, kind, callback)
+            else:
+                self.wait()
+                self.move(src, dst, kind, callback)
+        self.close()
+
+    def submit(self, src, dst, kind, done=None):
+        """Schedule moving `src` to `dst`, and call `done` if it succeeded"""
+        self.slots.acquire()
+        future = self.pool.submit(self.move, src, dst, kind, done)
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def wait(self):
+        """Wait for all submitted moves to finish"""
+        for _ in range(self.max_pending):
+            self.slots.acquire()
+        for _ in range(self.max_pending):
+            self.slots.release()
+
+    def move(self, src, dst, kind, done=None):
+        try:
+            moved = move(src, dst, kind, make_path=self.make_path,
+                         copier=self.copier, link_mode=self.link_mode)
+        except Exception as e:
+            log.error("move failed: `%s` --> `%s`: %s", src, dst, e)
+            self.failed.append((src, dst, e))
+        else:
+            if moved and done is not None:
+                done()
+
+    def close(self):
+        """Wait for all submitted moves to finish"""
+        self.pool.shutdown(wait=True)
+        self.copier.close()
+
+
+def classify(sort_rule, path):
+    """
+    Return the destination of `path` according to `sort_rule`, or the action
+    (rules.Skip, rules.SkipRecurse or rules.Unhandled) it returned or raised.
+    """
+    try:
+        return sort_rule(path)
+    except (rules.Unhandled, rules.Skip, rules.SkipRecurse) as action:
+        return type(action)
+
+
+# the sorting rule of a worker process, see ProcessPoolClassifier
+_worker_sort_rule = None
+
+
+def _initialize_worker(sort_rule, cwd):
+    global _worker_sort_rule
+    _worker_sort_rule = sort_rule
+    os.chdir(cwd)
+
+
+def _classify_chunk(paths):
+    return [classify(_worker_sort_rule, path) for path in paths]
+
+
+class ProcessPoolClassifier(object):
+    """
+    Classifies paths on a pool of worker processes, for rules files whose
+    callable destinations are expensive, e.g. because they read the files.
+
+    Paths are fed in one at a time and sent to the workers in chunks, the
+    (path, destination) results come back in the order the paths were fed.
+    The sorting rule is pickled for every worker, a RulesFileClassifier does
+    this by loading its rules file again in the worker.
+    """
+
+    def __init__(self, sort_rule, jobs, cwd, chunk_size=256, max_pending=None):
+        """
+        Parameters
+        ----------
+        sort_rule: function(path: str) --> destination
+            the sorting rule, see Organizer
+
+        jobs: int
+            number of worker processes
+
+        cwd: str
+            working directory of the workers, that paths are relative to
+
+        chunk_size: int
+            number of paths sent to a worker at once
+
+        max_pending: int
+            maximum number of chunks that are submitted, but whose results
+            have not been returned yet. Defaults to two per worker.
+        """
+        self.pool = ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_initialize_worker,
+            initargs=(sort_rule, cwd),
+        )
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 2 * jobs
+
+        self.chunk = []
+        self.pending = deque()
+
+    def feed(self, path):
+        """
+        Queue `path` for classification, and return a list of the
+        (path, destination) pairs that became available.
+        """
+        self.chunk.append(path)
+        if len(self.chunk) < self.chunk_size:
+            return []
+
+        self.submit()
+        results = []
+        while len(self.pending) > self.max_pending:
+            results.extend(self.collect())
+        return results
+
+    def flush(self):
+        """Wait for and return the (path, destination) pairs of all queued paths"""
+        self.submit()
+        results = []
+        while self.pending:
+            results.extend(self.collect())
+        return results
+
+    def submit(self):
+        if self.chunk:
+            chunk, self.chunk = self.chunk, []
+            self.pending.append((chunk, self.pool.submit(_classify_chunk, chunk)))
+
+    def collect(self):
+        chunk, future = self.pending.popleft()
+        return zip(chunk, future.result())
+
+    def close(self):
+        self.pool.shutdown(wait=True)
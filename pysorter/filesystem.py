@@ -1,10 +1,23 @@
 from __future__ import print_function
 
+import ctypes
+import ctypes.util
+import errno
 import logging
 import os
 import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from itertools import chain
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
 log = logging.getLogger(__name__)
 
 
@@ -74,6 +87,17 @@ def name(path):
 # --------------------------------------------------------------------------
 #  Common
 # --------------------------------------------------------------------------
+@contextmanager
+def working_directory(path):
+    """Change the working directory to `path` for the duration of the block"""
+    _pwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(_pwd)
+
+
 def save_cwd(function):
     def func(*args, **kwargs):
         _pwd = os.getcwd()
@@ -85,25 +109,551 @@ def save_cwd(function):
     return func
 
 
+def scan_tree(top, skip=None, prune=None, recurse=True, index=None, start='', entered=None):
+    """
+    Walk the directory `top` top-down, like os.walk, but stream its entries
+    from os.scandir instead of building lists of names.
+
+    Yields (path, entry) pairs, where `path` is the canonical path of the entry
+    relative to `top` (directories end in '/') and `entry` is its os.DirEntry,
+    which caches its type and, once requested, its stat information. Within a
+    directory files are yielded as they are read, followed by its directories.
+    Only the directories are held in memory until the directory is done.
+
+    Parameters
+    ----------
+    top: str
+        directory to walk
+
+    skip: dict
+        maps canonical directory paths ('' for `top`) to sets of names within
+        that directory that are not yielded nor descended into.
+
+    prune: set
+        canonical paths of directories that must not be descended into. It is
+        checked just before a directory is entered, so it may be updated while
+        the walk is in progress.
+
+    recurse: boolean
+        descend into subdirectories?
+
+    index: state.StateIndex
+        consulted before a directory is read; the entries of directories it
+        reports as unchanged are not yielded, but the subdirectories it lists
+        for them are walked. The subdirectories of the directories that are
+        read are passed to its `scanned`.
+
+    start: str
+        canonical path of a directory within `top` to walk instead, the
+        paths that are yielded remain relative to `top`.
+
+    entered: function(path: str)
+        called with the canonical path of every directory whose entries
+        are about to be yielded.
+    """
+    skip = skip or {}
+    prune = prune if prune is not None else set()
+
+    pending = [start]
+    while pending:
+        base = pending.pop()
+        if base in prune:
+            continue
+
+        if index is not None:
+            subdirs = index.unchanged_subdirs(base)
+            if subdirs is not None:
+                if recurse:
+                    pending.extend(subdirs)
+                continue
+
+        try:
+            scanner = os.scandir(os.path.join(top, base))
+        except OSError:
+            # the directory was moved away or cannot be read
+            continue
+
+        if entered is not None:
+            entered(base)
+
+        names = skip.get(base)
+        dirs = []
+        with scanner:
+            for entry in scanner:
+                if names and entry.name in names:
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    yield base + entry.name, entry
+
+        for entry in dirs:
+            yield base + entry.name + '/', entry
+
+        subdirs = [base + entry.name + '/' for entry in dirs if not entry.is_symlink()]
+        if index is not None:
+            index.scanned(base, subdirs)
+        if recurse:
+            pending.extend(reversed(subdirs))
+
+
+class DirectoryIndex(object):
+    """
+    Answers whether paths exist from the names in their directory, which is
+    read with a single os.scandir the first time one of its paths is asked
+    for, instead of a stat per path. Changes made after that are not seen.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # absolute directory path --> set of names in it
+        self.names = {}
+
+    def entries(self, directory):
+        names = self.names.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory) as scanner:
+                    names = set(entry.name for entry in scanner)
+            except OSError:
+                # it does not exist (yet), or is not a directory
+                names = set()
+            self.names[directory] = names
+        return names
+
+    def exists(self, path):
+        """Does the absolute path `path` exist, like os.path.lexists?"""
+        directory, name = os.path.split(path.rstrip('/'))
+        return name in self.entries(directory)
+
+
 # --------------------------------------------------------------------------
 #  File related
 # --------------------------------------------------------------------------
 
-def move_file(src, dst):
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+
+def _load_renameat2():
+    """Return libc's renameat2, or None if it has none (not Linux, or glibc < 2.28)"""
+    try:
+        renameat2 = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    return renameat2
+
+
+_renameat2 = _load_renameat2()
+
+
+def rename_noreplace(src, dst):
+    """
+    Rename `src` to `dst` in one system call that fails with FileExistsError
+    if `dst` exists. Returns False, without doing anything, where that is not
+    supported, or when `src` and `dst` are on different filesystems.
+    """
+    global _renameat2
+    if _renameat2 is None:
+        return False
+
+    result = _renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_NOREPLACE)
+    if result == 0:
+        return True
+
+    code = ctypes.get_errno()
+    if code == errno.ENOSYS:
+        # the kernel lacks it
+        _renameat2 = None
+        return False
+    if code in (errno.EXDEV, errno.EINVAL):
+        # another filesystem, or one that does not support the flag
+        return False
+    raise OSError(code, os.strerror(code), src, None, dst)
+
+
+_copy_file_range = getattr(os, 'copy_file_range', None)
+
+
+def _copy_range(fd_in, fd_out, offset, count):
+    """Copy `count` bytes at `offset` of `fd_in` to the same offset of `fd_out`"""
+    end = offset + count
+    while offset < end:
+        copied = None
+        if _copy_file_range is not None:
+            try:
+                copied = _copy_file_range(fd_in, fd_out, end - offset, offset, offset)
+            except OSError as e:
+                # older kernels only copy within a filesystem
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        if copied is None:
+            data = os.pread(fd_in, min(end - offset, 1024 * 1024), offset)
+            copied = os.pwrite(fd_out, data, offset) if data else 0
+
+        if not copied:
+            raise OSError(errno.EIO, "File shrank while it was copied")
+        offset += copied
+
+
+class CrossDeviceCopier(object):
+    """
+    Moves files to other filesystems, where they cannot be renamed to. The
+    data is copied within the kernel by os.copy_file_range, or with pread and
+    pwrite where that is not supported, and files larger than `chunk_size`
+    are copied in chunks on `jobs` threads. A copy gets the metadata of its
+    source, and is fsynced and checked for its size before it takes the
+    place of its destination and the source is removed.
+
+    It can be shared by threads. `bytes_copied` and `seconds` are the totals
+    over all copies, see `rate`.
+    """
+
+    def __init__(self, chunk_size=32 * 1024 * 1024, jobs=4):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.jobs = jobs
+
+        self.pool = None
+        self.lock = threading.Lock()
+
+        self.bytes_copied = 0
+        self.seconds = 0.0
+
+    def copy(self, src, dst):
+        """
+        Copy the file `src` to `dst` with its metadata, like shutil.copy2,
+        which it can stand in for as the `copy_function` of shutil.move.
+        """
+        start = time.perf_counter()
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            self.copy_data(fsrc.fileno(), fdst.fileno(), size)
+            os.fsync(fdst.fileno())
+            if os.fstat(fdst.fileno()).st_size != size:
+                raise OSError(errno.EIO, "Copy has the wrong size", dst)
+        shutil.copystat(src, dst)
+
+        with self.lock:
+            self.bytes_copied += size
+            self.seconds += time.perf_counter() - start
+        return dst
+
+    def copy_data(self, fd_in, fd_out, size):
+        if size <= self.chunk_size or self.jobs < 2:
+            _copy_range(fd_in, fd_out, 0, size)
+            return
+
+        # the chunks are written at their offsets, in any order
+        os.ftruncate(fd_out, size)
+        pool = self.get_pool()
+        chunks = [pool.submit(_copy_range, fd_in, fd_out, offset, min(self.chunk_size, size - offset))
+                  for offset in range(0, size, self.chunk_size)]
+        for chunk in chunks:
+            chunk.result()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+            return self.pool
+
+    def move(self, src, dst):
+        """
+        Move the file `src` to `dst` by copying it, raising FileExistsError
+        instead of replacing `dst` if it exists.
+        """
+        _check_free(dst)
+        partial = os.path.join(os.path.dirname(dst), '.{}.{}.part'.format(
+            os.path.basename(dst), uuid.uuid4().hex
+        ))
+        try:
+            self.copy(src, partial)
+            if not rename_noreplace(partial, dst):
+                os.link(partial, dst)
+                os.unlink(partial)
+        except BaseException:
+            if os.path.lexists(partial):
+                os.unlink(partial)
+            raise
+        os.unlink(src)
+
+    def rate(self):
+        """Return the number of bytes copied per second"""
+        return self.bytes_copied / self.seconds if self.seconds else 0.0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+
+# ways of placing an entry at its destination, see `link_file`
+LINK_MODES = ('move', 'hardlink', 'symlink', 'reflink')
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink_file(src, dst, copier=None):
+    """
+    Make `dst` a copy of the file `src` that shares its data, on filesystems
+    that support the FICLONE ioctl (Btrfs, XFS, ...), and a full copy with
+    the CrossDeviceCopier `copier` elsewhere. The copy gets the metadata of
+    `src`. Raises FileExistsError if `dst` exists.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        try:
+            try:
+                if fcntl is None:
+                    raise OSError(errno.ENOTTY, "ioctl is not available")
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                    raise
+                size = os.fstat(fsrc.fileno()).st_size
+                (copier or CrossDeviceCopier()).copy_data(fsrc.fileno(), fdst.fileno(), size)
+        except BaseException:
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+    return dst
+
+
+def link_file(src, dst, mode, copier=None):
+    """
+    Place the file `src` at `dst` without moving it, as a hard link, a
+    symbolic link or a reflinked copy, depending on `mode`. Raises
+    FileExistsError if `dst` exists.
+    """
+    if mode == 'hardlink':
+        os.link(src, dst, follow_symlinks=False)
+    elif mode == 'symlink':
+        os.symlink(src, dst)
+    elif mode == 'reflink':
+        reflink_file(src, dst, copier)
+    else:
+        raise ValueError("Unknown link mode: {}".format(mode))
+
+
+def link_dir(src, dst, mode, copier=None):
+    """
+    Place the directory `src` at `dst` without moving it, as a symbolic link,
+    or as a copy of the directory tree in which every file is hard linked or
+    reflinked, depending on `mode`. Raises FileExistsError if `dst` exists.
+    """
+    if mode == 'symlink':
+        os.symlink(src, dst, target_is_directory=True)
+        return
+
+    if mode == 'hardlink':
+        copy = os.link
+    elif mode == 'reflink':
+        def copy(s, d):
+            return reflink_file(s, d, copier)
+    else:
+        raise ValueError("Unknown link mode: {}".format(mode))
+
+    _check_free(dst)
+    shutil.copytree(src, dst, symlinks=True, copy_function=copy)
+
+
+def move_file(src, dst, copier=None):
+    """
+    Move the file `src` to `dst`, raising FileExistsError instead of
+    replacing `dst` if it exists. Moves to other filesystems are done
+    by the CrossDeviceCopier `copier`, if given.
+    """
     if not os.path.isfile(src):
         raise OSError("Source path is not a file: {}".format(src))
-    shutil.move(src, dst)
+
+    if rename_noreplace(src, dst):
+        return
+
+    try:
+        # fails atomically if `dst` exists
+        os.link(src, dst, follow_symlinks=False)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        if copier is not None and e.errno == errno.EXDEV and not os.path.islink(src):
+            copier.move(src, dst)
+            return
+        # a filesystem without hard links
+        _check_free(dst)
+        shutil.move(src, dst)
+    else:
+        os.unlink(src)
+
+
+def _check_free(dst):
+    if os.path.lexists(dst):
+        raise FileExistsError(errno.EEXIST, "Destination exists", dst)
 
 
 # --------------------------------------------------------------------------
 #  Directory related
 # --------------------------------------------------------------------------
 
-def move_dir(src, dst):
-    """Moves the source directory INTO the destination"""
+def move_dir(src, dst, copier=None):
+    """
+    Move the directory `src` to `dst`, raising FileExistsError if `dst` exists.
+    Its files are copied by the CrossDeviceCopier `copier`, if given, when
+    `dst` is on another filesystem.
+    """
     if not os.path.isdir(src):
         raise OSError("Source path is not a directory: {}".format(src))
-    shutil.move(src, dst)
+    if not rename_noreplace(src, dst):
+        _check_free(dst)
+        shutil.move(src, dst, copy_function=copier.copy if copier else shutil.copy2)
+
+class _DirectoryNode(object):
+    __slots__ = ('parent', 'location', 'path', 'entries', 'read', 'gone')
+
+    def __init__(self, parent, location, path=None):
+        self.parent = parent
+        # canonical path on disk, and after the moves
+        self.location = location
+        self.path = location if path is None else path
+        # entries it will have after the moves, once they are counted
+        self.entries = 0
+        self.read = False
+        # moved out of the tree, or within a directory that is
+        self.gone = False
+
+
+class EmptyDirOverlay(object):
+    """
+    Counts the entries of the directories of a tree while it is walked by
+    scan_tree, to find the directories that a MovePlan would leave empty,
+    without walking the tree again like collect_terminal_empty_dirs. The
+    directories that the walk did not read are counted by `empty_dirs`.
+
+    Feed it every path that the walk yields to `add`, and pass its
+    `entered` method to scan_tree.
+    """
+
+    def __init__(self, root, skip=None):
+        super().__init__()
+        self.root = root
+        self.skip = skip or {}
+
+        top = _DirectoryNode(None, '')
+        # canonical path on disk --> node, and all nodes, parents first
+        self.nodes = {'': top}
+        self.order = [top]
+
+    def entered(self, path):
+        node = self.nodes.get(path)
+        if node is None:
+            # within a directory that was not read, see `empty_dirs`
+            return
+        node.read = True
+        for name in self.skip.get(path, ()):
+            if os.path.lexists(os.path.join(self.root, path, name)):
+                node.entries += 1
+
+    def add(self, path, entry):
+        """Count the canonical `path`, with its os.DirEntry, yielded by the walk"""
+        parent = self.nodes.get(_parent_dir(path))
+        if parent is None or not parent.read:
+            return
+        parent.entries += 1
+        if path.endswith('/') and not entry.is_symlink():
+            self.new_node(parent, path)
+
+    def new_node(self, parent, location, path=None):
+        node = _DirectoryNode(parent, location, path)
+        self.nodes[location] = node
+        self.order.append(node)
+        return node
+
+    def read_tree(self, node):
+        """Count the entries of `node` and of all directories within it"""
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            node.read = True
+            try:
+                with os.scandir(os.path.join(self.root, node.location)) as scanner:
+                    for entry in scanner:
+                        node.entries += 1
+                        if entry.is_dir(follow_symlinks=False):
+                            name = entry.name + '/'
+                            pending.append(self.new_node(node, node.location + name, node.path + name))
+            except OSError:
+                # unreadable, so it cannot be found to be empty
+                node.entries += 1
+
+    def nearest_node(self, path):
+        """Return the node of the nearest existing directory that holds `path`"""
+        while True:
+            path = _parent_dir(path)
+            node = self.nodes.get(path)
+            if node is not None:
+                return node
+
+    def empty_dirs(self, plan):
+        """
+        Return the absolute paths of the directories that carrying out `plan`,
+        whose source must be `root`, would leave empty, including those
+        that are empty already.
+        """
+        prefix = os.path.join(self.root, '')
+        operations = [(src, dst[len(prefix):] if dst.startswith(prefix) else None)
+                      for src, (_, dst, _) in zip(plan.sources, plan)]
+
+        # a moved directory takes its tree along
+        for src, dst in operations:
+            node = self.nodes.get(src)
+            if node is None:
+                continue
+            if dst is None:
+                node.gone = True
+            else:
+                node.path = dst + '/'
+                node.parent = self.nearest_node(dst)
+
+        for node in list(self.order):
+            if node.parent is not None:
+                if node.parent.gone:
+                    node.gone = True
+                elif node.parent.path != _parent_dir(node.path) and node.location == node.path:
+                    node.path = node.parent.path + node.location[len(node.parent.location):]
+            if not node.read and not node.gone:
+                self.read_tree(node)
+
+        for src, dst in operations:
+            parent = self.nodes.get(_parent_dir(src))
+            if parent is not None:
+                parent.entries -= 1
+            if dst is not None:
+                self.nearest_node(dst).entries += 1
+
+        # remove the empty directories, and cascade to their parents
+        empty = [node for node in self.order if node.parent is not None and not node.gone
+                 and not node.entries]
+        empties = []
+        while empty:
+            node = empty.pop()
+            empties.append(os.path.join(self.root, node.path[:-1]))
+            parent = node.parent
+            parent.entries -= 1
+            if parent.parent is not None and not parent.gone and not parent.entries:
+                empty.append(parent)
+        return empties
+
+
+def _parent_dir(path):
+    """Return the canonical parent directory of the canonical path `path`"""
+    return path[:path.rfind('/', 0, -1) + 1]
+
 
 def collect_terminal_empty_dirs(root, move_tuples):
     """
@@ -209,20 +759,84 @@ def collect_terminal_empty_dirs(root, move_tuples):
 
 
 def remove_empty_dirs(path):
-    """Recursively removes empty direcotries contained within path"""
-
-    # apparently the next loop does not return... ever
-    for root, dirs, files in os.walk(path, topdown=False):  # pragma: no cover
-        log.debug("[clean_empty.at] %s", path)
-
-        # don't remove the source directory!
-        if os.path.normpath(root) == os.path.normpath(path):
-            break
+    """
+    Remove the directories within `path` that are empty, or that only hold
+    directories that are removed, reading each directory once.
+    """
+    top = os.path.normpath(path)
+
+    # directories in the order they were read, parents before children
+    order = []
+    parents = {}
+    counts = {}
+
+    pending = [top]
+    while pending:
+        directory = pending.pop()
+        order.append(directory)
+        count = 0
+        try:
+            with os.scandir(directory) as scanner:
+                for entry in scanner:
+                    count += 1
+                    if entry.is_dir(follow_symlinks=False):
+                        parents[entry.path] = directory
+                        pending.append(entry.path)
+        except OSError:
+            # unreadable, so it cannot be found to be empty
+            count += 1
+        counts[directory] = count
+
+    # children before their parents, so that removals cascade upwards
+    for directory in reversed(order):
+        if directory == top or counts[directory]:
+            continue
+        try:
+            os.rmdir(directory)
+        except OSError as e:
+            log.debug("cannot remove %s: %s", directory, e)
+            continue
+        log.debug("rmdir %s", directory)
+        counts[parents[directory]] -= 1
 
-        if len(os.listdir(root)) == 0:
-            os.rmdir(root)
-            log.debug("rmdir %s", root)
 
+def remove_emptied_dirs(path, dirs):
+    """
+    Remove the directories `dirs` within `path` that are empty, and
+    their parents that become empty, up to `path` itself.
+    """
+    top = os.path.normpath(path)
+    for directory in sorted(set(dirs), reverse=True):
+        directory = os.path.normpath(directory)
+        while directory != top and directory.startswith(os.path.join(top, '')):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # not empty, or already gone
+                break
+            log.debug("rmdir %s", directory)
+            directory = os.path.dirname(directory)
+
+
+def select_emptied_dirs(empty, dirs):
+    """
+    Return the absolute paths in `empty`, the directories that would be
+    empty after some moves, that remove_emptied_dirs would remove for the
+    directories `dirs` that the moves emptied: those in `dirs`, and their
+    parents that become empty, as long as all directories within them go.
+    """
+    dirs = set(os.path.normpath(directory) for directory in dirs)
+    children = {}
+    for path in empty:
+        children.setdefault(os.path.dirname(os.path.normpath(path)), []).append(path)
+
+    removed = set()
+    for path in sorted(empty, key=lambda path: path.count(os.sep), reverse=True):
+        normal = os.path.normpath(path)
+        within = children.get(normal, ())
+        if (normal in dirs or within) and all(child in removed for child in within):
+            removed.add(path)
+    return [path for path in empty if path in removed]
 
 
 def make_path(path):
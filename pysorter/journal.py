@@ -0,0 +1,150 @@
+"""
+    A write-ahead journal of planned and completed moves, so that an
+    interrupted run can be resumed
+"""
+from __future__ import print_function
+
+import json
+import logging
+import os
+import threading
+
+from .plan import MovePlan
+
+log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """
+    Records a MovePlan before it is executed, followed by the indices of the
+    operations as they complete. Records are appended in batches and every
+    batch is flushed and fsynced, so that at most one batch of completions is
+    lost when the process is killed.
+
+    The journal is a file of JSON lines: the plan in the format written by
+    MovePlan.dump, a {"planned": n} record once all n operations are written,
+    {"done": [index, ...]} records, and a final {"finished": true} record.
+    """
+
+    def __init__(self, path, batch_size=1000):
+        super().__init__()
+        self.path = path
+        self.batch_size = batch_size
+
+        self.file = None
+        self.buffer = []
+        self.completed = []
+        self.lock = threading.Lock()
+
+    def start(self, plan):
+        """Write a new journal for `plan`, replacing any existing one"""
+        self.file = open(self.path, 'w')
+        plan.dump(self)
+        self.sync()
+        self.write_record({'planned': len(plan)})
+        self.sync()
+
+    def reopen(self):
+        """Continue appending to an existing journal"""
+        self.file = open(self.path, 'a')
+
+    def write(self, text):
+        """Buffer `text`, see MovePlan.dump"""
+        self.buffer.append(text)
+        if len(self.buffer) >= 2 * self.batch_size:
+            self.sync()
+
+    def write_record(self, record):
+        self.write(json.dumps(record))
+        self.write('\n')
+
+    def sync(self):
+        """Write out all buffered records, and wait until they are on disk"""
+        self.file.write(''.join(self.buffer))
+        del self.buffer[:]
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def mark_done(self, index):
+        """Record that the operation at `index` of the plan was carried out"""
+        with self.lock:
+            self.completed.append(index)
+            if len(self.completed) >= self.batch_size:
+                self.flush_done()
+
+    def flush_done(self):
+        if self.completed:
+            self.write_record({'done': self.completed})
+            self.completed = []
+        self.sync()
+
+    def finish(self):
+        """Record that the whole plan was carried out, and close the journal"""
+        with self.lock:
+            self.flush_done()
+            self.write_record({'finished': True})
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            if self.buffer or self.completed:
+                self.flush_done()
+            self.file.close()
+            self.file = None
+
+    def read(self):
+        """
+        Return a (plan, done, finished) tuple from the journal on disk, where
+        `done` is the set of indices of completed operations. `plan` is None
+        if the journal was interrupted before the whole plan was written.
+        """
+        operations = []
+        records = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    value = json.loads(line)
+                except ValueError:
+                    # a partially written last line
+                    break
+                if isinstance(value, dict) and not operations and 'format' in value:
+                    operations.append(line)
+                elif isinstance(value, list):
+                    operations.append(line)
+                else:
+                    records.append(value)
+
+        done = set()
+        planned = None
+        finished = False
+        for record in records:
+            done.update(record.get('done', ()))
+            planned = record.get('planned', planned)
+            finished = finished or record.get('finished', False)
+
+        plan = MovePlan.parse(operations) if operations else None
+        if plan is None or planned != len(plan):
+            return None, done, finished
+        return plan, done, finished
+
+
+def pending_operations(plan, done):
+    """
+    Return the indices of the operations of `plan` that still have to be
+    carried out, given the set of indices `done`.
+
+    Operations that were in flight when the journal was interrupted are
+    considered done when their source is gone and their destination exists,
+    those whose source and destination both exist are skipped.
+    """
+    pending = []
+    for index, (src, dst, _) in enumerate(plan):
+        if index in done:
+            continue
+        if not os.path.lexists(dst):
+            pending.append(index)
+        elif os.path.lexists(src.rstrip('/')):
+            log.warning("destination exists, skipping: `%s` --> `%s`", src, dst)
+        else:
+            log.debug("already moved: `%s` --> `%s`", src, dst)
+    return pending
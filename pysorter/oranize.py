@@ -6,12 +6,30 @@ from __future__ import print_function
 import logging
 
 import os
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
 
+from . import executors
 from . import rules
 from . import filesystem as fs
+from .plan import DIRECTORY, FILE, MovePlan
+from .stats import Stats
 
 log = logging.getLogger(__name__)
 
+# the shell command printed in dry runs, by link mode and kind
+_DRY_RUN_COMMANDS = {
+    ('move', FILE): 'mv',
+    ('move', DIRECTORY): 'mv',
+    ('hardlink', FILE): 'ln',
+    ('hardlink', DIRECTORY): 'cp -al',
+    ('symlink', FILE): 'ln -s',
+    ('symlink', DIRECTORY): 'ln -s',
+    ('reflink', FILE): 'cp -p --reflink=auto',
+    ('reflink', DIRECTORY): 'cp -a --reflink=auto',
+}
+
+
 def escape_singles(string):
     """escapes all single quotes in a string"""
     return string.replace("'", r"\'")
@@ -28,7 +46,16 @@ class Organizer(object):
 
                  do_process_dirs=False,
                  do_recurse=False,
-                 do_remove_empty_dirs=False):
+                 do_remove_empty_dirs=False,
+
+                 jobs=1,
+                 classify_jobs=1,
+                 state=None,
+                 index_destinations=False,
+                 link_mode='move',
+                 coalesce_dirs=False,
+                 remove_only_emptied=False,
+                 stats=False):
         """
         Construct a new instance of Organizer for organizing some directory
         using certain parameters
@@ -69,6 +96,47 @@ class Organizer(object):
 
         do_remove_empty_dirs: boolean
             toggles recursive empty directory removal
+
+        remove_only_emptied: boolean
+            only remove the directories that organizing emptied, and their
+            parents that became empty, instead of walking the source
+            directory again for all empty directories.
+
+        jobs: int
+            number of threads to move files with. With more than one, failed
+            moves are collected in `failed` instead of being raised.
+
+        classify_jobs: int
+            number of processes to classify files with, which pays off when
+            the sorting rule is expensive. The sorting rule must be picklable,
+            as a RulesFileClassifier from `load_file` is. The plan is still
+            made in this process, in the same order as without workers.
+            The workers are started once, and kept until `close`.
+
+        state: state.StateIndex
+            index of the directories organized by earlier runs, the entries
+            of those that did not change are not processed again.
+
+        index_destinations: boolean
+            check for existing destinations by reading each destination
+            directory once, instead of a stat per path. Only dry runs and
+            the destinations of directories are checked, real runs leave
+            finding existing files to the moves, which never replace them.
+
+        link_mode: str
+            one of fs.LINK_MODES: 'move' entries to their destination, or
+            leave them where they are and place a 'hardlink', 'symlink' or
+            'reflink' copy there, see fs.link_file and fs.link_dir.
+
+        coalesce_dirs: boolean
+            move a directory as a whole, instead of its files one by one, when
+            that comes to the same result, see `coalesce`. Only done when the
+            emptied source directory would be removed anyway, or stays as it
+            is because entries are hard linked or reflinked.
+
+        stats: boolean
+            count the paths and time the phases of organizing in `stats`,
+            a stats.Stats that `organize` returns. Without, it is None.
         """
         dest_dir = dest_dir or source_dir
 
@@ -90,27 +158,58 @@ class Organizer(object):
         # to the directory to be sorted and should exclude any starting ./
 
         self.no_process = no_process or set()
+
+        self.state = state
+        if state is not None:
+            state_path = os.path.abspath(state.path)
+            if state_path.startswith(os.path.join(self.path_source, '')):
+                self.no_process = set(self.no_process)
+                self.no_process.add(os.path.relpath(state_path, self.path_source))
+
+        # directories that should not be recursed into, ending in a '/'
         self.no_recurse = set()
 
         self.is_dry_run = dry_run
 
         self.do_remove_empty_dirs = do_remove_empty_dirs
+        self.remove_only_emptied = remove_only_emptied
         self.do_recurse = do_recurse
         self.do_process_dirs = do_process_dirs
 
-        # --- variables used in a dry run
+        self.jobs = jobs
+        self.classify_jobs = classify_jobs
+        # executors.ProcessPoolClassifier, see `classifier_pool`
+        self.classifiers = None
 
-        # functions as an overlay of the destination directory,
-        # so that changes in the source directory may be reflected through it.
+        self.index_destinations = index_destinations
+        self.destination_index = None
+
+        if link_mode not in fs.LINK_MODES:
+            raise ValueError("Unknown link mode: {}".format(link_mode))
+        self.link_mode = link_mode
+        self.coalesce_dirs = coalesce_dirs
+
+        # the moves decided on by `plan`
+        self.move_plan = None
+        self.failed = []
 
-        self.dry_src = set()
-        self.dry_dst = set()
-        self.dry_mv_tuples = []
         self.dry_rmdir = []
+        self.overlay = None
 
         self.files = {}
 
-    @fs.save_cwd
+        self.stats = None
+        if stats:
+            self.stats = Stats()
+            self.instrument()
+
+    @property
+    def dry_mv_tuples(self):
+        """absolute (src, dst) pairs of all moves that were planned"""
+        if self.move_plan is None:
+            return []
+        return self.move_plan.move_tuples()
+
     def sortrule_destination(self, path):
         """
         Invokes self.sortrule.destination, ensured that  Skip, SkipReturn or Unhandled
@@ -121,57 +220,363 @@ class Organizer(object):
             raise retval()
         return retval
 
-    @fs.save_cwd
-    def organize(self):
+    def instrument(self):
         """
-        The `main` function for organization.
+        Wrap the methods of this instance that `stats` times or counts calls
+        of, so that instances without stats run the methods as they are.
         """
-        os.chdir(self.path_source)
+        stats = self.stats
+        self.walk = stats.timed('walk', self.walk)
+        self.sortrule_destination = stats.timed('classify', self.sortrule_destination)
+        self.destination_exists = stats.timed('conflicts', self.destination_exists)
+        self.remove_empty_dirs = stats.timed('remove empty dirs', self.remove_empty_dirs)
+        self.process = stats.counted('seen', self.process)
 
-        def filter_no_process(base, alist, skipset=self.no_process):
-            """
-            Removes items from a list returned by os.walk, in place.
-            """
-            L = len(alist)
-            for idx, i in enumerate(list(reversed(alist))):
-                i = fs.cjoin(base, i)
-                if i in skipset:
-                    del alist[L - idx - 1]
+    def organize(self):
+        """
+        The `main` function for organization. Returns `stats`.
+        """
+        self.apply(self.plan())
+        self.save_state()
+        return self.stats
 
-        for base, dirs, files in os.walk('.'):
-            filter_no_process(base, files)
-            filter_no_process(base, dirs)
+    def close(self):
+        """Stop the worker processes that classify files, if any were started"""
+        if self.classifiers is not None:
+            self.classifiers.close()
+            self.classifiers = None
 
-            for file in files:
-                self.process(fs.cjoin(base, file))
+    def organize_paths(self, paths):
+        """
+        Organize only the entries at the canonical `paths`, see `plan_paths`.
+        Only the directories that were emptied by it are cleaned up.
+        """
+        self.apply(self.plan_paths(paths), cleanup_all=False)
 
-            if self.do_process_dirs:
-                for dir in dirs:
-                    self.process(fs.cjoin(base, dir, is_dir=True))
-                filter_no_process(base, dirs, skipset=self.no_recurse)
-                self.no_recurse = set()  # clear out
+    def apply(self, plan, done=None, cleanup_all=True):
+        """
+        Carry out (or print, in a dry run) the moves of a MovePlan, which may
+        have been made by an earlier run, and clean up empty directories.
+        `done` is called with the index of every completed move.
+        """
+        self.move_plan = plan
+        if self.stats is not None:
+            self.stats.add('planned', len(plan))
 
-            if not self.do_recurse:
-                del dirs[:]
+        if self.is_dry_run:
+            for src, dst, kind in plan:
+                command = _DRY_RUN_COMMANDS[self.link_mode, kind]
+                print("{} '{}' '{}'".format(command, escape_singles(src), escape_singles(dst)))
+        else:
+            self.execute(plan, done=done)
+            # the paths of directories that were moved away may be used again
+            self.no_recurse.difference_update(
+                src for src, kind in zip(plan.sources, plan.kinds) if kind == DIRECTORY
+            )
 
         if self.do_remove_empty_dirs:
-            if self.is_dry_run:
+            self.remove_empty_dirs(plan, only_emptied=self.remove_only_emptied or not cleanup_all)
+
+    def remove_empty_dirs(self, plan, only_emptied=False):
+        """
+        Remove (or print, in a dry run) the empty directories in the source
+        directory, or with `only_emptied`, only those that the moves of
+        `plan` emptied, so that the source directory is not read again.
+        """
+        emptied = set(os.path.dirname(src.rstrip('/')) for src, _, _ in plan)
+
+        if self.is_dry_run:
+            if self.overlay is not None:
+                self.dry_rmdir = self.overlay.empty_dirs(plan)
+                self.overlay = None
+            else:
+                # the plan was not made by walking the source directory
                 self.dry_rmdir = fs.collect_terminal_empty_dirs(self.path_source, self.dry_mv_tuples)
-                for path in self.dry_rmdir:
-                    print("rmdir '{}'".format(escape_singles(path)))
+            if only_emptied:
+                self.dry_rmdir = fs.select_emptied_dirs(self.dry_rmdir, emptied)
+            for path in self.dry_rmdir:
+                print("rmdir '{}'".format(escape_singles(path)))
+        elif only_emptied:
+            fs.remove_emptied_dirs(self.path_source, emptied)
+        else:
+            fs.remove_empty_dirs(self.path_source)
+
+    def execute(self, plan, done=None):
+        """
+        Carry out the moves of a MovePlan, with the executor chosen by `jobs`
+        """
+        if self.jobs > 1:
+            mover = executors.ThreadPoolMover(self.jobs, link_mode=self.link_mode)
+        else:
+            mover = executors.SerialMover(link_mode=self.link_mode)
+        stats = self.stats
+        if stats is None:
+            mover.apply(plan, done=done)
+        else:
+            with stats.phase('make dirs'):
+                mover.make_path.make_all(plan.destination_dirs())
+            moved = stats.counts['moved']
+            try:
+                with stats.phase('move'):
+                    mover.apply(plan, done=stats.counting('moved', done))
+            finally:
+                stats.add('failed', len(mover.failed))
+            # the rest found their destination taken by then
+            stats.add('conflicted', len(plan) - (stats.counts['moved'] - moved) - len(mover.failed))
+        self.failed.extend(mover.failed)
+
+        copier = mover.copier
+        if copier.bytes_copied:
+            log.info("Copied %.1f MiB to other filesystems at %.1f MiB/s",
+                     copier.bytes_copied / 2 ** 20, copier.rate() / 2 ** 20)
+
+    def save_state(self):
+        """
+        Record the directories walked by `plan` in the state index, unless
+        nothing was moved because of a dry run, or some moves failed.
+        """
+        if self.state is None or self.is_dry_run:
+            return
+        if self.failed:
+            log.warning("Not recording state, as some moves failed")
+            return
+        self.state.save()
+
+    def rules_directory(self):
+        """
+        Return a context in which the sorting rule is applied. Only rules
+        that may look at the files themselves, which they are given relative
+        to the source directory, need it to be the working directory.
+        """
+        if getattr(self.sort_rule, 'uses_cwd', True):
+            return fs.working_directory(self.path_source)
+        return nullcontext()
+
+    def plan(self):
+        """
+        Walk the source directory and return a MovePlan of all moves that
+        organizing it consists of, without moving anything.
+        """
+        self.move_plan = MovePlan(self.path_source, self.path_dest)
+        self.new_destination_index()
+
+        if self.state is not None:
+            self.state.begin(self.path_source)
+
+        # a dry run finds the directories it would empty during the walk
+        self.overlay = None
+        if self.is_dry_run and self.do_remove_empty_dirs:
+            self.overlay = fs.EmptyDirOverlay(self.path_source, self.skip_map())
+
+        with self.rules_directory():
+            self.walk('', index=self.state, overlay=self.overlay)
+
+        if self.coalesce_dirs and (self.do_remove_empty_dirs and self.link_mode == 'move' or
+                                   self.link_mode in ('hardlink', 'reflink')):
+            self.move_plan = self.coalesce(self.move_plan)
+        return self.move_plan
+
+    def coalesce(self, plan):
+        """
+        Return `plan` with the moves of all files of a directory replaced by a
+        move of the directory itself, where that has the same outcome: every
+        entry of the directory is a file that is moved under its own name into
+        one destination directory, which does not exist yet, and which no
+        other operation moves anything into.
+        """
+        groups = OrderedDict()
+        for index, (src, kind) in enumerate(zip(plan.sources, plan.kinds)):
+            parent = src[:src.rfind('/') + 1]
+            if kind == FILE and parent:
+                groups.setdefault(parent, []).append(index)
+
+        # number of operations into each directory, and below each directory
+        into = Counter()
+        below = Counter()
+        for _, dst, _ in plan:
+            directory = os.path.dirname(dst)
+            into[directory] += 1
+            while directory != os.path.dirname(directory):
+                directory = os.path.dirname(directory)
+                below[directory] += 1
+
+        coalesced = {}
+        for parent, indices in groups.items():
+            src_dir = os.path.join(plan.source, parent[:-1])
+            dst_dir = os.path.dirname(plan.operation(indices[0])[1])
+
+            if into[dst_dir] != len(indices) or below[dst_dir]:
+                continue
+            # all into the same directory, under their own names
+            if any(os.path.split(plan.operation(i)[1]) != (dst_dir, fs.name(plan.sources[i]))
+                   for i in indices):
+                continue
+            if os.path.lexists(dst_dir) or fs.cjoin(dst_dir, is_dir=True).startswith(
+                    fs.cjoin(src_dir, is_dir=True)):
+                continue
+            try:
+                if len(os.listdir(src_dir)) != len(indices):
+                    continue
+            except OSError:
+                continue
+
+            log.debug("moving `%s` as a whole to `%s`", src_dir, dst_dir)
+            coalesced[indices[0]] = (parent, dst_dir)
+            coalesced.update((i, None) for i in indices[1:])
+
+        if not coalesced:
+            return plan
+
+        result = MovePlan(plan.source, plan.destination)
+        for index in range(len(plan)):
+            if index not in coalesced:
+                _, dst, kind = plan.operation(index)
+                result.add(plan.sources[index], dst, kind)
+            elif coalesced[index] is not None:
+                parent, dst_dir = coalesced[index]
+                result.add(parent, dst_dir, DIRECTORY)
+        return result
+
+    def plan_paths(self, paths):
+        """
+        Return a MovePlan for organizing only the entries at the canonical
+        `paths`, relative to the source directory, such as those that were
+        added or changed. Directories among them are walked when organizing
+        recursively, and '' stands for the whole source directory.
+        """
+        self.move_plan = MovePlan(self.path_source, self.path_dest)
+        self.new_destination_index()
+        self.overlay = None
+
+        with self.rules_directory():
+            paths = set(paths)
+            if '' in paths:
+                self.walk('')
             else:
-                fs.remove_empty_dirs(self.path_source)
+                self.walk_paths(paths)
+        return self.move_plan
+
+    def new_destination_index(self):
+        """
+        Start a new index of the destination directories, if they are indexed.
+        Destinations of the plan being made are looked up in the plan instead.
+        """
+        if self.index_destinations:
+            self.destination_index = fs.DirectoryIndex()
+
+    def destination_exists(self, dst, kind):
+        if kind == FILE and not self.is_dry_run:
+            # moving files never replaces their destination, so finding
+            # it exists can be left to the move
+            return False
+        if self.destination_index is not None:
+            return self.destination_index.exists(dst)
+        return os.path.exists(dst)
+
+    def walk_paths(self, paths):
+        skip = self.skip_map()
+        for path in sorted(paths):
+            if not self.is_included(path, paths, skip):
+                continue
+            if not os.path.lexists(os.path.join(self.path_source, path)):
+                continue
+
+            if fs.is_file(path):
+                self.process(path)
+                continue
 
+            if self.do_process_dirs:
+                self.process(path)
+            if self.do_recurse and path not in self.no_recurse:
+                self.walk(path)
 
-    def process(self, src):
+    def is_included(self, path, paths, skip):
+        """
+        Would walking the source directory reach the canonical `path`, and
+        would it not be reached by walking any directory in `paths` instead?
+        """
+        parent, name = os.path.split(path.rstrip('/'))
+        if parent and not self.do_recurse:
+            return False
+
+        while True:
+            if name in skip.get(fs.cjoin(parent, is_dir=True) if parent else '', ()):
+                return False
+            if not parent:
+                return True
+
+            parent_dir = fs.cjoin(parent, is_dir=True)
+            if parent_dir in self.no_recurse or parent_dir in paths:
+                return False
+            parent, name = os.path.split(parent)
+
+    def skip_map(self):
+        """Return `no_process` in the form that fs.scan_tree takes for `skip`"""
+        skip = {}
+        for path in self.no_process:
+            base, name = os.path.split(path.rstrip('/'))
+            skip.setdefault(fs.cjoin(base, is_dir=True) if base else '', set()).add(name)
+        return skip
+
+    def classifier_pool(self):
+        """
+        Return the executors.ProcessPoolClassifier that classifies files on
+        `classify_jobs` processes, starting it the first time, or None.
+        """
+        if self.classify_jobs > 1 and self.classifiers is None:
+            self.classifiers = executors.ProcessPoolClassifier(
+                self.sort_rule, self.classify_jobs, self.path_source
+            )
+        return self.classifiers
+
+    def walk(self, start, index=None, overlay=None):
+        """
+        Process the entries found by walking the directory `start`,
+        relative to the source directory, and count them in the
+        fs.EmptyDirOverlay `overlay`.
         """
-        Take a single path to a directory or a file and
-        apply some action to it, as defined by the sorting rule
+        classifier = self.classifier_pool()
+        tree = fs.scan_tree(self.path_source, skip=self.skip_map(), prune=self.no_recurse,
+                            recurse=self.do_recurse, index=index, start=start,
+                            entered=overlay.entered if overlay is not None else None)
+        for path, entry in tree:
+            if overlay is not None:
+                overlay.add(path, entry)
+
+            if classifier is not None:
+                if fs.is_file(path):
+                    for src, destination in classifier.feed(path):
+                        self.process(src, destination)
+                    continue
+                # directories may be moved, or excluded from the walk, so
+                # the files before them must be dealt with first
+                for src, destination in classifier.flush():
+                    self.process(src, destination)
+
+            if self.do_process_dirs or fs.is_file(path):
+                self.process(path)
+
+        if classifier is not None:
+            for src, destination in classifier.flush():
+                self.process(src, destination)
+
+    def process(self, src, destination=None):
+        """
+        Take a single path to a directory or a file and add the
+        action defined by the sorting rule for it to the plan.
+
+        `destination` is the result of the sorting rule for `src`, if it
+        was already applied, as done by executors.classify.
         """
         name = fs.name(src)
 
         try:
-            raw_dst = self.sortrule_destination(src)
+            if destination is None:
+                raw_dst = self.sortrule_destination(src)
+            elif destination in rules.actions:
+                raise destination()
+            else:
+                raw_dst = destination
 
             # a relative destination
             if not os.path.isabs(raw_dst):
@@ -187,37 +592,32 @@ class Organizer(object):
 
         except rules.Unhandled:
             self.unhandled_paths.add(src)
+            if self.stats is not None:
+                self.stats.counts['unhandled'] += 1
             return
         except rules.Skip:
+            if self.stats is not None:
+                self.stats.counts['skipped'] += 1
             return
         except rules.SkipRecurse:
+            if self.stats is not None:
+                self.stats.counts['skipped'] += 1
             if src.endswith('/'):
-                # strip the trailing slash because the path will be compared
-                # with `dirs` returned by os.walk (which do not contain
-                # a trailing slash `/`)
-                self.no_recurse.add(src.rstrip('/'))
+                self.no_recurse.add(src)
+                return
             log.warning('SkipRecurse cannot be used with a file argument, Skip assumed: %s', src)
             return
 
-        if os.path.exists(dst) or (dst in self.dry_dst):
+        kind = FILE if fs.is_file(src) else DIRECTORY
+        if self.move_plan.has_destination(dst) or self.destination_exists(dst, kind):
             log.info("destination exists: `%s` --> `%s`", src, dst)
+            if self.stats is not None:
+                self.stats.counts['conflicted'] += 1
             return
 
-        if self.is_dry_run:
-            abs_src = os.path.join(self.path_source, src)
-            self.dry_src.add(abs_src)
-            self.dry_dst.add(dst)
-
-            self.dry_mv_tuples.append((abs_src, dst))
-
-            if not fs.is_file(src):
-                self.no_recurse.add(src.rstrip('/'))
-            print("mv '{}' '{}'".format(escape_singles(abs_src), escape_singles(dst)))
-            return
-
-        fs.make_path(os.path.dirname(dst))
-        log.info("move {} --> {}".format(src, dst))
-        if fs.is_file(src):
-            fs.move_file(src, dst)
+        if kind == FILE:
+            self.move_plan.add(src, dst, FILE)
         else:
-            fs.move_dir(src, dst)
+            # the directory will have been moved away
+            self.no_recurse.add(src)
+            self.move_plan.add(src, dst, DIRECTORY)
@@ -0,0 +1,124 @@
+"""
+    A plan of the moves that organizing a directory consists of
+"""
+from __future__ import print_function
+
+import json
+import os
+
+FILE = 'f'
+DIRECTORY = 'd'
+
+# first line of a saved plan
+_HEADER = 'pysorter-plan'
+_VERSION = 1
+
+
+class MovePlan(object):
+    """
+    An ordered list of (src, dst, kind) move operations, where `kind` is
+    FILE or DIRECTORY.
+
+    To keep large plans compact, sources are stored relative to the `source`
+    directory and destinations relative to the `destination` directory, when
+    they lie within it. Iterating over a plan yields absolute paths.
+    """
+
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+
+        self.sources = []
+        self.destinations = []
+        self.kinds = []
+
+        # absolute destinations of all operations
+        self.taken = set()
+
+        self._destination_prefix = os.path.join(destination, '')
+
+    def add(self, src, dst, kind):
+        """
+        Append moving the canonical path `src`, relative to the source
+        directory, to the absolute path `dst`.
+        """
+        self.taken.add(dst)
+        if dst.startswith(self._destination_prefix):
+            dst = dst[len(self._destination_prefix):]
+
+        self.sources.append(src)
+        self.destinations.append(dst)
+        self.kinds.append(kind)
+
+    def has_destination(self, dst):
+        """Is the absolute path `dst` the destination of an operation?"""
+        return dst in self.taken
+
+    def operation(self, index):
+        """Return the absolute (src, dst, kind) operation at `index`"""
+        return (os.path.join(self.source, self.sources[index]),
+                os.path.join(self.destination, self.destinations[index]),
+                self.kinds[index])
+
+    def __iter__(self):
+        join = os.path.join
+        for src, dst, kind in zip(self.sources, self.destinations, self.kinds):
+            yield join(self.source, src), join(self.destination, dst), kind
+
+    def __len__(self):
+        return len(self.sources)
+
+    def move_tuples(self):
+        """Return a list of the absolute (src, dst) pairs of all operations"""
+        return [(src, dst) for src, dst, _ in self]
+
+    def destination_dirs(self):
+        """Return the set of absolute directories that operations move into"""
+        join = os.path.join
+        dirs = set(os.path.dirname(dst) for dst in set(self.destinations))
+        return set(join(self.destination, d) for d in dirs)
+
+    def subset(self, indices):
+        """Return a plan of the operations at `indices`, in that order"""
+        plan = MovePlan(self.source, self.destination)
+        for i in indices:
+            _, dst, kind = self.operation(i)
+            plan.add(self.sources[i], dst, kind)
+        return plan
+
+    def save(self, path):
+        """Write the plan to the file `path`, one operation per line"""
+        with open(path, 'w') as f:
+            self.dump(f)
+
+    def dump(self, f):
+        header = {'format': _HEADER, 'version': _VERSION,
+                  'source': self.source, 'destination': self.destination}
+        f.write(json.dumps(header))
+        f.write('\n')
+        for operation in zip(self.sources, self.destinations, self.kinds):
+            f.write(json.dumps(operation))
+            f.write('\n')
+
+    @classmethod
+    def load(cls, path):
+        """Read a plan that was written by `save`"""
+        with open(path, 'r') as f:
+            return cls.parse(f)
+
+    @classmethod
+    def parse(cls, lines):
+        lines = iter(lines)
+        header = json.loads(next(lines, 'null'))
+        if not isinstance(header, dict) or header.get('format') != _HEADER:
+            raise ValueError("Not a pysorter plan")
+        if header.get('version') != _VERSION:
+            raise ValueError("Unsupported plan version: {}".format(header.get('version')))
+
+        plan = cls(header['source'], header['destination'])
+        for line in lines:
+            if not line.strip():
+                continue
+            src, dst, kind = json.loads(line)
+            plan.add(src, os.path.join(plan.destination, dst), kind)
+        return plan
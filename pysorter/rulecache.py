@@ -0,0 +1,159 @@
+"""
+    An on-disk cache of loaded and indexed rules files, so that starting
+    pysorter does not execute the rules file and analyse every rule again
+"""
+from __future__ import print_function
+
+import builtins
+import dis
+import hashlib
+import logging
+import marshal
+import mimetypes
+import os
+import pickle
+import sys
+import tempfile
+import types
+
+log = logging.getLogger(__name__)
+
+# changes whenever what is cached changes
+_CACHE_VERSION = 1
+
+
+def _stamp(path):
+    """Return the (path, size, mtime_ns) of the file `path`, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return path, st.st_size, st.st_mtime_ns
+
+
+def _global_names(code):
+    """Return the global names that the code object `code`, or any code within it, uses"""
+    names = set()
+    for instruction in dis.get_instructions(code):
+        if 'GLOBAL' in instruction.opname or 'NAME' in instruction.opname:
+            names.add(instruction.argval)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+class FrozenFunction(object):
+    """
+    A function of a rules file, which cannot be pickled as it is not part of
+    a module, in the form of its compiled code. See `freeze_function`.
+    """
+
+    def __init__(self, function):
+        super().__init__()
+        self.name = function.__name__
+        self.code = marshal.dumps(function.__code__)
+        self.defaults = function.__defaults__
+
+    def thaw(self):
+        """Return the function again, with only the builtins as its globals"""
+        code = marshal.loads(self.code)
+        return types.FunctionType(code, {'__builtins__': builtins}, self.name, self.defaults)
+
+
+def freeze_function(function):
+    """
+    Return a picklable form of the destination function `function` of a rules
+    file, which `thaw_function` turns back into a function. Raises ValueError
+    for functions that use anything but their arguments and the builtins,
+    since those are not available without executing the rules file.
+    """
+    if not isinstance(function, types.FunctionType):
+        # pickled as it is, if it can be
+        return function
+    if function.__closure__ or function.__kwdefaults__:
+        raise ValueError("{} is a closure or has keyword defaults".format(function.__name__))
+    unknown = _global_names(function.__code__) - set(dir(builtins))
+    if unknown:
+        raise ValueError("{} uses {}".format(function.__name__, ', '.join(sorted(unknown))))
+    return FrozenFunction(function)
+
+
+def thaw_function(frozen):
+    """Return the function that `freeze_function` returned `frozen` for"""
+    if isinstance(frozen, FrozenFunction):
+        return frozen.thaw()
+    return frozen
+
+
+class RuleCache(object):
+    """
+    Holds the rules of the rules file `path`, as the picklable list of
+    (regex, kind, value) that RulesFileClassifier.load_file makes of them,
+    together with the index it built of them, in a file in `directory`.
+
+    The cache is stale when the path, mtime or contents of the rules file
+    change, or the version of Python or pysorter, or the files that the
+    mimetypes module reads, which the default rules are made from. Modules
+    that the rules file imports are not checked.
+    """
+
+    def __init__(self, directory, path, prefilter=False):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.abspath(path)
+        self.prefilter = prefilter
+
+        name = hashlib.sha256(self.path.encode('utf-8', 'surrogateescape')).hexdigest()[:32]
+        self.cache_path = os.path.join(directory, name + '.rules.pickle')
+
+    def key(self):
+        from . import __version__
+
+        with open(self.path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        return (
+            _CACHE_VERSION,
+            __version__,
+            sys.version,
+            self.path,
+            os.stat(self.path).st_mtime_ns,
+            digest,
+            self.prefilter,
+            tuple(_stamp(known) for known in mimetypes.knownfiles),
+        )
+
+    def load(self):
+        """Return the cached (rules, index), or None if there are none or they are stale"""
+        try:
+            with open(self.cache_path, 'rb') as f:
+                key, rules, index = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # anything may go wrong unpickling a damaged file
+            log.warning("Ignoring unreadable rules cache %s: %s", self.cache_path, e)
+            return None
+
+        if key != self.key():
+            log.debug("Rules cache is stale: %s", self.cache_path)
+            return None
+        return rules, index
+
+    def store(self, rules, index):
+        """Write the `rules` and their `index` to the cache"""
+        try:
+            data = pickle.dumps((self.key(), list(rules), index), pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            log.debug("Cannot cache the rules of %s: %s", self.path, e)
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(prefix='.rules-', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, self.cache_path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
@@ -3,8 +3,17 @@ Module for the base regex rule implementation
 """
 from __future__ import print_function
 
+import hashlib
+import json
 import logging
+import os
 import re
+import time
+from collections import OrderedDict, namedtuple
+from itertools import chain
+from string import Formatter
+
+from .rulecache import RuleCache, freeze_function, thaw_function
 
 log = logging.getLogger(__name__)
 
@@ -35,36 +44,280 @@ class SkipRecurse(Exception):
 
 actions = frozenset([Unhandled, Skip, SkipRecurse])
 
+# file name suffix of the rule order learned by AdaptiveClassifier
+_ORDER_SUFFIX = '.order.json'
+
 
 class RulesFileClassifier(object):
     """
     Default rule implementation that
     uses the regex definitions as given in a `filetypes.py` specification file.
 
+    Rules whose pattern is a plain literal suffix, such as ``\\.(?i)pdf$``, and
+    whose destination does not depend on the match are placed in a suffix
+    index, so they are found with a few dictionary lookups instead of a regex
+    search each. All other rules are scanned in their original order, only up
+    to the first indexed rule that matched, unless they were reordered with
+    `reorder`, which keeps the outcome the same.
+
+    With `prefilter` set, the literal text that every match of a scanned rule
+    must contain is extracted up front, and the rule is only searched when
+    that text occurs in the path.
+
+    `index` is the result of `index_state` of a classifier of the same
+    `rules`, which is used instead of analysing them again.
     """
 
-    def __init__(self, rules):
+    def __init__(self, rules, prefilter=False, index=None):
         super().__init__()
         self.rules = rules
+        self.prefilter = prefilter
 
-    def first_match(self, finditer):
-        for match in finditer:
-            return match
-        return None
+        # the rules file this classifier was loaded from, and the directory
+        # of its RuleCache, see `load_file`
+        self.source = None
+        self.cache_dir = None
 
-    def destination(self, path):
-        for R, function in self.rules:
-            match = self.first_match(R.finditer(path))
+        # may the rules look at the files they are given, which requires the
+        # source directory to be the working directory? see `load_file`
+        self.uses_cwd = True
+
+        # (index, compiled pattern, matcher, required, rest) of rules that must
+        # be searched, where `required` is a (literal, ignorecase) pair or None,
+        # and `rest` the lowest index of this and all later rules, see `reorder`
+        self.scanned = []
+
+        # suffix --> (index, matcher), for case sensitive and folded suffixes
+        self.suffixes = {}
+        self.folded_suffixes = {}
+
+        # number of leading rules that only depend on a path's extension, see
+        # `extension_key`, and the most dots in any of their suffixes
+        self.extension_rules = 0
+        self.extension_dots = 0
+
+        if index is not None:
+            self.load_index(index)
+        else:
+            self.build_index()
+
+        self.suffix_lengths = sorted(set(
+            len(_) for _ in chain(self.suffixes, self.folded_suffixes)
+        ))
+
+    def build_index(self):
+        """Sort the rules into the suffix index and the scanned rules"""
+        prefilter = self.prefilter
+        for index, (regex, matcher) in enumerate(self.rules):
+            suffix = None
+            if is_constant(matcher):
+                suffix = literal_suffix(regex)
+
+            if suffix is None:
+                if is_string(regex):
+                    regex = re.compile(regex)
+                required = required_literal(regex) if prefilter else None
+                self.scanned.append((index, regex, matcher, required, index))
+                continue
+
+            literal, ignorecase = suffix
+            if index == self.extension_rules and is_extension(literal):
+                self.extension_rules += 1
+                self.extension_dots = max(self.extension_dots, literal.count('.'))
+
+            if ignorecase:
+                self.folded_suffixes.setdefault(literal.lower(), (index, matcher))
+            else:
+                self.suffixes.setdefault(literal, (index, matcher))
+
+    def index_state(self):
+        """
+        Return the index that `build_index` made, in terms of rule indices
+        only, so that it can be stored and given to the constructor again.
+        """
+        return {
+            'scanned': sorted((entry[0], entry[3]) for entry in self.scanned),
+            'suffixes': dict((literal, index) for literal, (index, _) in self.suffixes.items()),
+            'folded_suffixes': dict((literal, index) for literal, (index, _)
+                                    in self.folded_suffixes.items()),
+            'extension_rules': self.extension_rules,
+            'extension_dots': self.extension_dots,
+        }
+
+    def load_index(self, state):
+        """Take over an index returned by `index_state`"""
+        rules = self.rules
+        for index, required in state['scanned']:
+            regex, matcher = rules[index]
+            if is_string(regex):
+                regex = re.compile(regex)
+            self.scanned.append((index, regex, matcher, required, index))
+        self.suffixes = dict((literal, (index, rules[index][1]))
+                             for literal, index in state['suffixes'].items())
+        self.folded_suffixes = dict((literal, (index, rules[index][1]))
+                                    for literal, index in state['folded_suffixes'].items())
+        self.extension_rules = state['extension_rules']
+        self.extension_dots = state['extension_dots']
+
+    def indexed_match(self, path):
+        """
+        Return the (index, matcher) of the first indexed suffix rule
+        that matches `path`, or None.
+        """
+        best = None
+        longest = self.suffix_lengths[-1]
+        # `$` also matches right before a trailing newline
+        tails = (path, path[:-1]) if path.endswith('\n') else (path,)
+
+        for tail in tails:
+            folded = tail[-longest:].translate(_CASE_FOLDS).lower()
+            for length in self.suffix_lengths:
+                if length > len(tail):
+                    break
+                for key, table in ((tail[-length:], self.suffixes),
+                                   (folded[-length:], self.folded_suffixes)):
+                    hit = table.get(key)
+                    if hit is not None and (best is None or hit[0] < best[0]):
+                        best = hit
+        return best
+
+    def extension_key(self, path):
+        """
+        Return the part of `path` that determines the outcome of the leading
+        `extension_rules`, i.e. the basename from its `extension_dots`-th last
+        dot (or its first dot) onwards, or None if there are no such rules.
+        """
+        if not self.extension_rules:
+            return None
+
+        start = path.rfind('/') + 1
+        key_start = len(path)
+        for _ in range(self.extension_dots):
+            dot = path.rfind('.', start, key_start)
+            if dot < 0:
+                break
+            key_start = dot
+        return path[key_start:]
+
+    def classify(self, path):
+        """
+        Return an (index, destination) pair for `path`, where `index` is the
+        index of the rule that matched, or (None, Unhandled) if none did.
+        """
+        hit = self.indexed_match(path) if self.suffix_lengths else None
+        limit = hit[0] if hit is not None else len(self.rules)
+
+        folded = None
+        for index, R, function, required, rest in self.scanned:
+            if rest > limit:
+                break
+            if index > limit:
+                continue
+            if required is not None:
+                literal, ignorecase = required
+                if ignorecase and folded is None:
+                    folded = path.translate(_CASE_FOLDS).lower()
+                if literal not in (folded if ignorecase else path):
+                    continue
+            match = R.search(path)
             if match:
-                return function(match, path)
-        raise Unhandled
+                return index, function(match, path)
+
+        if hit is not None:
+            return hit[0], hit[1](None, path)
+        return None, Unhandled
+
+    def scan_order(self):
+        """Return the indices of the scanned rules, in the order they are searched"""
+        return [entry[0] for entry in self.scanned]
+
+    def reorder(self, hits):
+        """
+        Search the scanned rules that decided the most paths first, given the
+        number of paths that each rule decided in the list `hits`, and return
+        the new `scan_order`.
+
+        A rule is only moved before the rules that decided fewer paths when
+        it cannot match any path that they match, because every match of
+        each ends in a literal suffix, and neither suffix ends in the other,
+        see `required_suffix`. The first rule that matches a path is then
+        the same as before.
+        """
+        entries = sorted(self.scanned, key=lambda entry: entry[0])
+        suffixes = dict((entry[0], required_suffix(entry[1])) for entry in entries)
+
+        order = []
+        for entry in entries:
+            index = entry[0]
+            position = len(order)
+            while position and hits[order[position - 1][0]] < hits[index] and \
+                    suffixes_disjoint(suffixes[order[position - 1][0]], suffixes[index]):
+                position -= 1
+            order.insert(position, entry)
+
+        self.set_scan_order([entry[0] for entry in order])
+        return self.scan_order()
+
+    def set_scan_order(self, order):
+        """
+        Search the scanned rules in the `order` of their indices, such as one
+        returned by `scan_order` before. Raises ValueError if it is not an order
+        of the scanned rules, or if it places a rule before another one that
+        could match the same path, see `reorder`.
+        """
+        by_index = dict((entry[0], entry) for entry in self.scanned)
+        if sorted(order) != sorted(by_index):
+            raise ValueError("Not an order of the scanned rules")
+
+        suffixes = {}
+        for position, index in enumerate(order):
+            for earlier in order[:position]:
+                if earlier < index:
+                    continue
+                for rule in (earlier, index):
+                    if rule not in suffixes:
+                        suffixes[rule] = required_suffix(by_index[rule][1])
+                if not suffixes_disjoint(suffixes[earlier], suffixes[index]):
+                    raise ValueError("Rule {} cannot be searched before rule {}".format(earlier, index))
+
+        scanned = []
+        rest = len(self.rules)
+        for index in reversed(order):
+            rest = min(rest, index)
+            scanned.append(by_index[index][:4] + (rest,))
+        scanned.reverse()
+        self.scanned = scanned
+
+    def destination(self, path):
+        index, destination = self.classify(path)
+        if index is None:
+            raise Unhandled
+        return destination
 
     @classmethod
-    def load_file(cls, path):
+    def load_file(cls, path, prefilter=False, cache_dir=None):
         """
         Load sorting rules from a text file (or module) and return
         a RulesFileClassifier containing all the sorting entries.
+
+        See the class documentation for `prefilter`. With `cache_dir`, the
+        rules and their index are kept in a rulecache.RuleCache there, and
+        the file is only executed again when it changed. Rules files with
+        destination functions that use more than their arguments and the
+        builtins are not cached, see rulecache.freeze_function.
         """
+        cache = None
+        if cache_dir is not None and os.path.isfile(path):
+            cache = RuleCache(cache_dir, path, prefilter=prefilter)
+            cached = cache.load()
+            if cached is not None:
+                state, index = cached
+                classifier = cls([_thaw_rule(*rule) for rule in state], prefilter=prefilter, index=index)
+                classifier.source = path
+                classifier.cache_dir = cache_dir
+                classifier.uses_cwd = any(kind == _FUNCTION for _, kind, _ in state)
+                return classifier
+
         # try loading as a module
         try:
             namespace = __import__(path)
@@ -77,53 +330,685 @@ class RulesFileClassifier(object):
             msg = "Configuration file missing RULES: {}".format(path)
             raise RuntimeError(msg)
 
-        rules = []
-        for regex, destination in namespace["RULES"]:
-            pattern = re.compile(regex)
-            matcher = None
-
-            if is_string(destination):
-                # destination --> format string
-                matcher = make_regex_rule_function(pattern, destination)
-            elif destination in actions:
-                # constant action ex. Skip
-                matcher = make_constant_function(destination)
-            elif callable(destination):
-                # custom processing_function(re_match, filepath)
-                matcher = destination
+        specs = namespace["RULES"]
+        rules = [make_rule(regex, destination) for regex, destination in specs]
+        uses_cwd = any(not is_string(destination) and destination not in actions
+                       for _, destination in specs)
+
+        classifier = cls(rules, prefilter=prefilter)
+        classifier.source = path
+        classifier.cache_dir = cache_dir
+        classifier.uses_cwd = uses_cwd
+        if cache is not None:
+            try:
+                state = [_freeze_rule(regex, destination, matcher)
+                         for (regex, destination), (_, matcher) in zip(specs, rules)]
+            except ValueError as e:
+                log.info("Not caching the rules of %s: %s", path, e)
             else:
-                msg = (
-                    "Unhandled type in rule list. "
-                    "Second item in pair must be "
-                    "callable, string or action: " + repr(destination)
-                )
-                raise ValueError(msg)
+                cache.store(state, classifier.index_state())
+        return classifier
 
-            rules.append((pattern, matcher))
+    def __reduce__(self):
+        # rules may hold closures and functions from the rules file, which
+        # cannot be pickled, so the rules file is loaded again instead
+        if self.source is None:
+            raise TypeError("Only classifiers created by load_file can be pickled")
+        return type(self).load_file, (self.source, self.prefilter, self.cache_dir)
 
-        return cls(rules)
+    def __call__(self, path):
+        return self.destination(path)
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class CachingClassifier(object):
+    """
+    Bounded LRU cache around a RulesFileClassifier.
+
+    Paths are cached by their `extension_key`, and only when the rule that
+    decided them is one of the classifier's leading `extension_rules`, which
+    are literal suffix rules with a constant destination. Every path that
+    shares that key is then guaranteed to end up at the same destination.
+    Paths decided by any other rule, such as those with capture groups or
+    callable destinations, are classified on every call.
+    """
+
+    def __init__(self, classifier, maxsize=4096):
+        super().__init__()
+        self.classifier = classifier
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def cacheable(self, index):
+        """Can the result of the rule at `index` (None if unhandled) be cached?"""
+        limit = self.classifier.extension_rules
+        if index is None:
+            return limit == len(self.classifier.rules)
+        return index < limit
+
+    def destination(self, path):
+        key = self.classifier.extension_key(path)
+        if key is not None:
+            try:
+                destination = self.cache[key]
+            except KeyError:
+                pass
+            else:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return destination
+
+        self.misses += 1
+        index, destination = self.classifier.classify(path)
+        if key is not None and self.cacheable(index):
+            self.cache[key] = destination
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return destination
+
+    @property
+    def uses_cwd(self):
+        return self.classifier.uses_cwd
+
+    def info(self):
+        """Return the hit and miss counts, in the style of functools.lru_cache"""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.cache))
+
+    def __reduce__(self):
+        return type(self), (self.classifier, self.maxsize)
 
     def __call__(self, path):
         return self.destination(path)
 
 
+class _ProfiledPattern(object):
+    """A compiled pattern, which counts and times its searches for a ProfilingClassifier"""
+
+    def __init__(self, classifier, index, pattern):
+        super().__init__()
+        self.pattern = pattern.pattern
+        self.flags = pattern.flags
+        self.compiled = pattern
+        self.index = index
+        self.classifier = classifier
+
+    def search(self, path):
+        classifier = self.classifier
+        start = time.perf_counter_ns()
+        classifier.attempts[self.index] += 1
+        try:
+            return self.compiled.search(path)
+        finally:
+            classifier.times_ns[self.index] += time.perf_counter_ns() - start
+
+
+class ProfilingClassifier(RulesFileClassifier):
+    """
+    RulesFileClassifier that records, for every rule, how often it was
+    attempted, how often it matched, and the time spent on it, to find rules
+    that never match and expensive patterns. Create it with `load_file`.
+
+    A scanned rule is attempted when its pattern is searched, and its time
+    includes the search and, when it matches, making the destination. The
+    literal suffix rules are all looked up at once in the suffix index, whose
+    lookups are counted in `index_lookups` and `index_time_ns` instead.
+
+    The rules are searched by RulesFileClassifier.classify, with their
+    patterns and matchers wrapped by `instrument`.
+    """
+
+    def __init__(self, rules, prefilter=False, index=None):
+        super().__init__(rules, prefilter=prefilter, index=index)
+        self.attempts = [0] * len(rules)
+        self.hits = [0] * len(rules)
+        self.times_ns = [0] * len(rules)
+        self.index_lookups = 0
+        self.index_time_ns = 0
+        self.instrument()
+
+    def indexed_match(self, path):
+        start = time.perf_counter_ns()
+        try:
+            return super().indexed_match(path)
+        finally:
+            self.index_lookups += 1
+            self.index_time_ns += time.perf_counter_ns() - start
+
+    def instrument(self):
+        """
+        Wrap the patterns and matchers of the rules with ones that count and
+        time their calls, so that `classify` itself stays as it is.
+        """
+        self.scanned = [(index, _ProfiledPattern(self, index, R), self.profiled(index, function),
+                         required, rest)
+                        for index, R, function, required, rest in self.scanned]
+        for table in (self.suffixes, self.folded_suffixes):
+            for literal, (index, function) in table.items():
+                # found in the index, so attempted only when it matched
+                table[literal] = index, self.profiled(index, function, attempt=True)
+
+    def profiled(self, index, function, attempt=False):
+        """Return the matcher `function` of the rule at `index`, counting its matches"""
+        attempts, hits, times_ns = self.attempts, self.hits, self.times_ns
+        clock = time.perf_counter_ns
+
+        def profiled(match, path):
+            start = clock()
+            hits[index] += 1
+            if attempt:
+                attempts[index] += 1
+            try:
+                return function(match, path)
+            finally:
+                times_ns[index] += clock() - start
+        return profiled
+
+    def profile(self):
+        """
+        Return a list with an OrderedDict of the counts of every rule, the
+        most expensive first, and among those that took no time, the most
+        frequent first.
+        """
+        rows = []
+        for index, (regex, _) in enumerate(self.rules):
+            rows.append(OrderedDict([
+                ('rule', index),
+                ('pattern', getattr(regex, 'pattern', regex)),
+                ('attempts', self.attempts[index]),
+                ('hits', self.hits[index]),
+                ('seconds', self.times_ns[index] / 1e9),
+            ]))
+        rows.sort(key=lambda row: (-row['seconds'], -row['hits'], row['rule']))
+        return rows
+
+    def profile_json(self):
+        """Return the profile as a JSON document, with the suffix index"""
+        return json.dumps(OrderedDict([
+            ('source', self.source),
+            ('index_lookups', self.index_lookups),
+            ('index_seconds', self.index_time_ns / 1e9),
+            ('rules', self.profile()),
+        ]), indent=2)
+
+    def format_profile(self, limit=None):
+        """Return the profile of the `limit` most expensive rules as a table, for printing"""
+        profile = self.profile()
+        lines = ['{:>6} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+            'rule', 'attempts', 'hits', 'ms', 'us/try', 'pattern')]
+        for row in profile[:limit]:
+            per_attempt = row['seconds'] * 1e6 / row['attempts'] if row['attempts'] else 0
+            lines.append('{:>6} {:>10} {:>10} {:>10.3f} {:>10.3f}  {}'.format(
+                row['rule'], row['attempts'], row['hits'], row['seconds'] * 1e3, per_attempt,
+                row['pattern']))
+        lines.append('suffix index: {} lookups, {:.3f} ms'.format(
+            self.index_lookups, self.index_time_ns / 1e6))
+        lines.append('{} of {} rules never matched'.format(
+            sum(not row['hits'] for row in profile), len(profile)))
+        return '\n'.join(lines)
+
+
+class AdaptiveClassifier(RulesFileClassifier):
+    """
+    RulesFileClassifier that counts the paths each rule decided, and learns
+    to search the scanned rules that decide the most paths first, see
+    `reorder`. The counts and the order are kept in the file `order_path`
+    next to the rules file, and carried on from there by `load_file`.
+
+    The literal suffix rules are found in the suffix index wherever they
+    are, and are left where they are.
+    """
+
+    def __init__(self, rules, prefilter=False, index=None):
+        super().__init__(rules, prefilter=prefilter, index=index)
+        self.hits = [0] * len(rules)
+
+    def classify(self, path):
+        index, destination = super().classify(path)
+        if index is not None:
+            self.hits[index] += 1
+        return index, destination
+
+    @classmethod
+    def load_file(cls, path, prefilter=False, cache_dir=None):
+        classifier = super().load_file(path, prefilter=prefilter, cache_dir=cache_dir)
+        classifier.load_order()
+        return classifier
+
+    def order_path(self):
+        """Return the path of the file with the learned order, or None"""
+        if self.source is None or not os.path.isfile(self.source):
+            return None
+        return os.path.splitext(self.source)[0] + _ORDER_SUFFIX
+
+    def rules_digest(self):
+        with open(self.source, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def load_order(self):
+        """
+        Carry on the counts and the order learned by earlier runs, if they
+        were learned with the same rules file.
+        """
+        path = self.order_path()
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as f:
+                learned = json.load(f)
+            if learned.get('rules') != self.rules_digest() or len(learned['hits']) != len(self.rules):
+                log.info("Rules changed, learning their order again")
+                return
+            self.set_scan_order(learned['order'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("Ignoring unusable rule order %s: %s", path, e)
+            return
+        self.hits = learned['hits']
+
+    def save_order(self):
+        """Reorder the rules by the counts so far, and write both to `order_path`"""
+        path = self.order_path()
+        if path is None:
+            return
+        order = self.reorder(self.hits)
+        try:
+            with open(path, 'w') as f:
+                json.dump(OrderedDict([
+                    ('rules', self.rules_digest()),
+                    ('order', order),
+                    ('hits', self.hits),
+                ]), f)
+        except OSError as e:
+            # such as next to the default rules, in a read-only installation
+            log.warning("Cannot save the rule order %s: %s", path, e)
+
+
 def is_string(obj):
     return isinstance(obj, str)
 
 
+# kinds of rules, as cached by RulesFileClassifier.load_file
+_CONSTANT = 'constant'
+_TEMPLATE = 'template'
+_FUNCTION = 'function'
+
+
+def _freeze_rule(regex, destination, matcher):
+    """Return a picklable (regex, kind, value) form of a rule made by `make_rule`"""
+    if is_constant(matcher):
+        return regex, _CONSTANT, matcher.constant
+    if is_string(destination):
+        return regex, _TEMPLATE, destination
+    return regex, _FUNCTION, freeze_function(destination)
+
+
+def _thaw_rule(regex, kind, value):
+    """Return the (regex, matcher) pair of a rule returned by `_freeze_rule`"""
+    if kind == _CONSTANT:
+        return regex, make_constant_function(value)
+    if kind == _TEMPLATE:
+        return make_rule(regex, value)
+    return regex, thaw_function(value)
+
+
+def make_rule(regex, destination):
+    """Return the (regex, matcher) pair of a rule of a rules file"""
+    if is_string(destination):
+        # destination --> format string, constant if it has no placeholders
+        if is_template(destination):
+            regex = re.compile(regex)
+        return regex, make_regex_rule_function(regex, destination)
+    if destination in actions:
+        # constant action ex. Skip
+        return regex, make_constant_function(destination)
+    if callable(destination):
+        # custom processing_function(re_match, filepath)
+        return regex, destination
+
+    msg = (
+        "Unhandled type in rule list. "
+        "Second item in pair must be "
+        "callable, string or action: " + repr(destination)
+    )
+    raise ValueError(msg)
+
+
 def make_constant_function(action):
     """Return a function that always returns `action`, regardless of its arguments"""
 
     def function(*args):
         return action
 
+    function.constant = action
     return function
 
 
+def is_constant(matcher):
+    """Does `matcher` return the same value for every match?"""
+    return hasattr(matcher, 'constant')
+
+
+# characters that match an ASCII letter under re.IGNORECASE, but
+# that str.lower() does not map onto that letter
+_CASE_FOLDS = {0x130: 'i', 0x131: 'i', 0x17f: 's', 0x212a: 'k'}
+
+# an unescaped inline ignorecase flag, which may appear anywhere in a suffix pattern
+_IGNORECASE_FLAG = re.compile(r'(?<!\\)\(\?i\)')
+
+
+def literal_suffix(regex):
+    """
+    Return a `(literal, ignorecase)` pair when the pattern `regex` only
+    matches paths ending in a literal string, or None otherwise.
+
+    Examples
+    --------
+    >>> literal_suffix(r'\\.pdf$')
+    ('.pdf', False)
+    >>> literal_suffix(r'\\.(?i)pdf$')
+    ('.pdf', True)
+    >>> literal_suffix(r'.*\\.tar\\.gz$')
+    ('.tar.gz', False)
+    >>> literal_suffix(r'^foo\\.pdf$') is None
+    True
+    >>> literal_suffix(r'\\.jpe?g$') is None
+    True
+    """
+    ignorecase = False
+    if not is_string(regex):
+        if regex.flags & ~(re.IGNORECASE | re.UNICODE):
+            return None
+        ignorecase = bool(regex.flags & re.IGNORECASE)
+        regex = regex.pattern
+
+    if not is_string(regex) or not regex.endswith('$'):
+        return None
+
+    regex, flags = _IGNORECASE_FLAG.subn('', regex)
+    ignorecase = ignorecase or bool(flags)
+
+    body = regex[:-1]
+    # a leading `.*` does not change whether the pattern is found
+    if body.startswith('.*'):
+        body = body[2:]
+
+    literal = []
+    chars = iter(body)
+    for c in chars:
+        if c == '\\':
+            c = next(chars, None)
+            if c is None or c.isalnum() or c == '_':
+                return None
+        elif c in '.^$*+?{}[]|()\n':
+            return None
+        literal.append(c)
+
+    literal = ''.join(literal)
+    if not literal or (ignorecase and not _is_ascii(literal)):
+        return None
+    return literal, ignorecase
+
+
+def required_literal(pattern):
+    """
+    Return a `(literal, ignorecase)` pair, where `literal` is text that every
+    match of the compiled `pattern` contains, or None if no such text is found.
+    Only characters outside of groups and character classes are considered,
+    and patterns with a top level alternation have no required literal.
+
+    Examples
+    --------
+    >>> required_literal(re.compile(r'^(\\d{4})-.+?\\.jpe?g$'))
+    ('.jp', False)
+    >>> required_literal(re.compile(r'(?i)/Camera\\d+/'))
+    ('/camera', True)
+    >>> required_literal(re.compile(r'foo|bar')) is None
+    True
+    """
+    if pattern.flags & re.VERBOSE:
+        return None
+    ignorecase = bool(pattern.flags & re.IGNORECASE)
+    source = pattern.pattern
+
+    runs = []
+    run = []
+
+    def end_run():
+        if run:
+            runs.append(''.join(run))
+            del run[:]
+
+    i = 0
+    while i < len(source):
+        c = source[i]
+        i += 1
+        if c == '\\':
+            c = source[i:i + 1]
+            i += 1
+            if not c or c.isalnum() or c == '_':
+                end_run()
+            else:
+                run.append(c)
+        elif c in '([':
+            end_run()
+            i = _skip_group(source, i - 1)
+        elif c == '|':
+            return None
+        elif c in '*?{':
+            # the preceding character is optional
+            if run:
+                run.pop()
+            end_run()
+            if c == '{':
+                i = source.find('}', i) + 1 or len(source)
+            if source[i:i + 1] in ('?', '+'):
+                i += 1
+        elif c == '+':
+            end_run()
+            if source[i:i + 1] in ('?', '+'):
+                i += 1
+        elif c in '.^$':
+            end_run()
+        else:
+            run.append(c)
+    end_run()
+
+    if not runs:
+        return None
+    literal = max(runs, key=len)
+    if ignorecase:
+        if not _is_ascii(literal):
+            return None
+        literal = literal.lower()
+    return literal, ignorecase
+
+
+def required_suffix(pattern):
+    """
+    Return a `(literal, ignorecase)` pair, where `literal` is text that every
+    match of the compiled `pattern` ends with, right before the end of the
+    path, or None if no such text is found. Like `literal_suffix`, but the
+    rest of the pattern may be anything other than a top level alternation.
+
+    Examples
+    --------
+    >>> required_suffix(re.compile(r'^(\\d{4})-.+?\\.jpg$'))
+    ('.jpg', False)
+    >>> required_suffix(re.compile(r'(?i)\\.jpe?g$'))
+    ('g', True)
+    >>> required_suffix(re.compile(r'\\.jpg|\\.png$')) is None
+    True
+    """
+    if pattern.flags & (re.VERBOSE | re.MULTILINE):
+        return None
+    ignorecase = bool(pattern.flags & re.IGNORECASE)
+    source = pattern.pattern
+
+    run = []
+    i = 0
+    while i < len(source):
+        c = source[i]
+        i += 1
+        if c == '\\':
+            c = source[i:i + 1]
+            i += 1
+            if c == 'Z' and i == len(source):
+                break
+            if not c or c.isalnum() or c == '_':
+                run = []
+            else:
+                run.append(c)
+        elif c in '([':
+            run = []
+            i = _skip_group(source, i - 1)
+        elif c == '|':
+            return None
+        elif c in '*?{':
+            # the preceding character is optional
+            run = []
+            if c == '{':
+                i = source.find('}', i) + 1 or len(source)
+            if source[i:i + 1] in ('?', '+'):
+                i += 1
+        elif c == '+':
+            # the preceding character is repeated
+            run = run[-1:]
+            if source[i:i + 1] in ('?', '+'):
+                i += 1
+        elif c == '$' and i == len(source):
+            break
+        elif c in '.^$':
+            run = []
+        else:
+            run.append(c)
+    else:
+        # not anchored at the end
+        return None
+
+    literal = ''.join(run)
+    if not literal or '\n' in literal or (ignorecase and not _is_ascii(literal)):
+        return None
+    return literal, ignorecase
+
+
+def suffixes_disjoint(first, second):
+    """
+    Can no path end in both of the `required_suffix` results `first` and
+    `second`? False when either is None.
+    """
+    if first is None or second is None:
+        return False
+    a, b = first[0], second[0]
+    if first[1] or second[1]:
+        a = a.translate(_CASE_FOLDS).lower()
+        b = b.translate(_CASE_FOLDS).lower()
+    return not (a.endswith(b) or b.endswith(a))
+
+
+def _skip_group(source, i):
+    """
+    Return the index just past the group or character class
+    that starts at `source[i]`.
+    """
+    depth = 0
+    class_start = None
+    while i < len(source):
+        c = source[i]
+        if c == '\\':
+            i += 2
+            continue
+        if class_start is not None:
+            # a `]` directly after `[` or `[^` is a literal
+            if c == ']' and i > class_start:
+                class_start = None
+                if depth == 0:
+                    return i + 1
+        elif c == '[':
+            class_start = i + 1
+            if source[class_start:class_start + 1] == '^':
+                class_start += 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+def is_extension(literal):
+    """
+    Is `literal` an extension like `.pdf` or `.tar.gz`, so that whether a path
+    ends in it only depends on the path's basename from a dot onwards?
+    """
+    return literal.startswith('.') and '/' not in literal
+
+
+def _is_ascii(string):
+    return all(ord(c) < 128 for c in string)
+
+
 def make_regex_rule_function(pattern, dstfmt):
     """
-    Return a path processing function.
+    Return a path processing function, that fills in the placeholders of the
+    format string `dstfmt` with the groups of a match of `pattern`.
+
+    The format string is parsed once, here, and its placeholders are checked
+    against the groups of `pattern`. When `dstfmt` has no placeholders, a
+    constant function is returned and `pattern` is not used.
     """
+    parts = parse_destination(dstfmt)
+
+    if all(field is None for _, field, _, _ in parts):
+        return make_constant_function(''.join(literal for literal, _, _, _ in parts))
+
+    auto_index = 0
+    numbering = None
+    template = []
+    simple = True
+    for literal, field, spec, conversion in parts:
+        if field is None:
+            template.append((literal, None, None, None))
+            continue
+
+        key = _FIELD_KEY.match(field).group(0)
+        if key != field or '{' in spec:
+            # attribute or item access, or nested placeholders
+            simple = False
+
+        if key == '' or key.isdigit():
+            style = 'manual' if key else 'automatic'
+            if numbering not in (None, style):
+                msg = "Destination string mixes automatic and manual numbering: {}"
+                raise ValueError(msg.format(dstfmt))
+            numbering = style
+            if key:
+                key = int(key)
+            else:
+                key = auto_index
+                auto_index += 1
+
+            if key > pattern.groups:
+                msg = "Destination string placeholders out of range: {}"
+                raise ValueError(msg.format(dstfmt))
+        elif key not in pattern.groupindex:
+            msg = "Destination string placeholder " "unknown key {}: {}".format(
+                repr(key), dstfmt
+            )
+            raise ValueError(msg)
+
+        template.append((literal, key, spec, _CONVERSIONS[conversion]))
+
+    if not simple:
+        def process(re_match, path):
+            pargs = [re_match.group(0)] + list(re_match.groups())
+            return dstfmt.format(*pargs, **re_match.groupdict())
+
+        return process
 
     def process(re_match, path):
         """
@@ -136,21 +1021,40 @@ def make_regex_rule_function(pattern, dstfmt):
 
         Returns
         -------
-
+        str: the destination
         """
-        # FIXME only re_match against the filename
-        try:
-            pargs = [re_match.group(0)] + list(re_match.groups())
-            destination = dstfmt.format(*pargs, **re_match.groupdict())
-        except IndexError:
-            msg = "Destination string placeholders out of range: {}"
-            raise ValueError(msg.format(dstfmt))
-        except KeyError as e:
-            msg = "Destination string placeholder " "unknown key {}: {}".format(
-                repr(e.args[0]), dstfmt
-            )
-            raise ValueError(msg)
-        log.debug("process: RE[%s](%s) --> %s", pattern.pattern, path, destination)
-        return destination
+        group = re_match.group
+        pieces = []
+        for literal, key, spec, conversion in template:
+            pieces.append(literal)
+            if key is not None:
+                value = group(key)
+                if conversion is not None:
+                    value = conversion(value)
+                pieces.append(format(value, spec))
+        return ''.join(pieces)
 
     return process
+
+
+# the group number or name that a placeholder refers to
+_FIELD_KEY = re.compile(r'[^.\[]*')
+
+_CONVERSIONS = {None: None, 'r': repr, 's': str, 'a': ascii}
+
+
+def parse_destination(dstfmt):
+    """
+    Split the format string `dstfmt` into (literal, field, spec, conversion)
+    tuples, as done by `string.Formatter.parse`.
+    """
+    try:
+        return list(Formatter().parse(dstfmt))
+    except ValueError as e:
+        msg = "Malformed destination string ({}): {}"
+        raise ValueError(msg.format(e, dstfmt))
+
+
+def is_template(dstfmt):
+    """Does the destination string `dstfmt` contain any placeholders?"""
+    return any(field is not None for _, field, _, _ in parse_destination(dstfmt))
@@ -0,0 +1,176 @@
+"""
+    A persistent index of the directories that were organized, so that later
+    runs can skip the directories whose entries did not change
+"""
+from __future__ import print_function
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+_SCHEMA_VERSION = '2'
+
+# directories modified this shortly before a scan started are not recorded,
+# since a later change within the timestamp granularity of the filesystem
+# would leave their mtime as it is
+RACY_MARGIN_NS = 2 * 10 ** 9
+
+
+def rules_key(path, *options):
+    """
+    Return a hash of the contents of the rules file `path`, and of any
+    `options` that change what organizing does.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(repr(options).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class StateIndex(object):
+    """
+    Records the device, inode and mtime of every directory that a run walked,
+    in an sqlite database, together with a key of the rules and options.
+
+    A directory whose mtime is unchanged has the same entries, so when the key
+    is unchanged as well, organizing them would come to the same result as the
+    last time, and they are not read again. Its subdirectories are still
+    checked, from the list of its subdirectories that was recorded with it,
+    and those that were not recorded themselves are read as usual.
+    Rules that look at more than the path, such as the contents of files,
+    and destinations that have been cleared since are not noticed.
+
+    A directory is only recorded when it did not change while it was being
+    organized. Directories that files were moved out of are therefore read
+    again by the next run.
+    """
+
+    def __init__(self, path, key):
+        super().__init__()
+        self.path = path
+        self.key = key
+
+        # canonical directory path ('' for the top) --> (dev, ino, mtime_ns)
+        self.known = {}
+        # canonical directory path --> paths of its subdirectories
+        self.subdirs = {}
+
+        # directories visited by the current walk and their stat before
+        self.visited = {}
+        # directories visited by the current walk --> paths of their subdirectories
+        self.listed = {}
+        self.skipped = 0
+        self.top = None
+        self.started = None
+
+        self.load()
+
+    def connect(self):
+        db = sqlite3.connect(self.path)
+        # keep the rollback journal in memory, as creating and removing it
+        # next to the database would change the mtime of that directory
+        db.execute('PRAGMA journal_mode=MEMORY')
+        return db
+
+    def load(self):
+        """Read the recorded directories, if they were made with the same key"""
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            db = self.connect()
+            try:
+                meta = dict(db.execute('SELECT name, value FROM meta'))
+                if meta.get('version') != _SCHEMA_VERSION or meta.get('key') != self.key:
+                    log.info("Rules or options changed, reading all directories again")
+                    return
+                rows = db.execute('SELECT path, dev, ino, mtime_ns FROM dirs')
+                self.known = dict((path, (dev, ino, mtime)) for path, dev, ino, mtime in rows)
+                for parent, path in db.execute('SELECT parent, path FROM subdirs'):
+                    self.subdirs.setdefault(parent, []).append(path)
+            finally:
+                db.close()
+        except sqlite3.DatabaseError as e:
+            log.warning("Ignoring unreadable state file %s: %s", self.path, e)
+            self.known = {}
+            self.subdirs = {}
+
+    def begin(self, top):
+        """Start a walk of the absolute directory `top`"""
+        self.top = top
+        self.started = time.time_ns()
+        self.visited = {}
+        self.listed = {}
+        self.skipped = 0
+
+    def stat(self, path):
+        st = os.stat(os.path.join(self.top, path), follow_symlinks=False)
+        return st.st_dev, st.st_ino, st.st_mtime_ns
+
+    def unchanged_subdirs(self, path):
+        """
+        Return the canonical paths of the recorded subdirectories of the
+        canonical directory `path` if it did not change since the last run,
+        otherwise None, in which case its entries must be read.
+        """
+        try:
+            before = self.stat(path)
+        except OSError:
+            return None
+
+        self.visited[path] = before
+        if self.known.get(path) != before:
+            return None
+
+        self.skipped += 1
+        subdirs = self.subdirs.get(path, [])
+        self.listed[path] = subdirs
+        return subdirs
+
+    def scanned(self, path, subdirs):
+        """
+        Note the canonical paths `subdirs` of the subdirectories found when
+        reading the entries of the canonical directory `path`.
+        """
+        self.listed[path] = subdirs
+
+    def save(self):
+        """
+        Record the directories of the last walk that did not change since
+        they were visited, replacing those of earlier runs.
+        """
+        newest = self.started - RACY_MARGIN_NS
+        rows = []
+        subdirs = []
+        for path, before in self.visited.items():
+            try:
+                after = self.stat(path)
+            except OSError:
+                continue
+            if after == before and after[2] < newest:
+                rows.append((path,) + after)
+                subdirs.extend((path, subdir) for subdir in self.listed.get(path, ()))
+
+        db = self.connect()
+        try:
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+                db.execute('CREATE TABLE IF NOT EXISTS dirs '
+                           '(path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, mtime_ns INTEGER)')
+                db.execute('CREATE TABLE IF NOT EXISTS subdirs (parent TEXT, path TEXT)')
+                db.execute('DELETE FROM dirs')
+                db.execute('DELETE FROM subdirs')
+                db.executemany('INSERT INTO dirs VALUES (?, ?, ?, ?)', rows)
+                db.executemany('INSERT INTO subdirs VALUES (?, ?)', subdirs)
+                db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                               [('version', _SCHEMA_VERSION), ('key', self.key)])
+        finally:
+            db.close()
+
+        log.debug("Recorded %d of %d directories, %d were unchanged",
+                  len(rows), len(self.visited), self.skipped)
@@ -0,0 +1,105 @@
+"""
+    Counters and timings of the phases of organizing, see Organizer.stats
+"""
+from __future__ import print_function
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+# phases, with those that are part of another one indented below it
+PHASES = OrderedDict([
+    ('walk', 0),
+    ('classify', 1),
+    ('conflicts', 1),
+    ('make dirs', 0),
+    ('move', 0),
+    ('remove empty dirs', 0),
+])
+
+COUNTERS = ('seen', 'planned', 'moved', 'skipped', 'unhandled', 'conflicted', 'failed')
+
+
+class Stats(object):
+    """
+    Counts the paths that organizing came across, and what became of them,
+    and the time spent in each phase, measured with time.perf_counter_ns.
+
+    An Organizer is only instrumented when it is given Stats, by wrapping
+    its methods with `timed` and `counted`, so that organizing without
+    costs nothing extra. Times add up over all runs of the Organizer.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.counts = OrderedDict((name, 0) for name in COUNTERS)
+        self.times_ns = OrderedDict((name, 0) for name in PHASES)
+        # counts that worker threads add to
+        self.lock = threading.Lock()
+
+    def add(self, name, n=1):
+        """Add `n` to the counter `name`, from any thread"""
+        with self.lock:
+            self.counts[name] += n
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the context to the phase `name`"""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.times_ns[name] += time.perf_counter_ns() - start
+
+    def timed(self, name, function):
+        """Return `function`, adding the time spent in it to the phase `name`"""
+        times_ns = self.times_ns
+        clock = time.perf_counter_ns
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                times_ns[name] += clock() - start
+        return timed
+
+    def counted(self, name, function):
+        """Return `function`, counting its calls in the counter `name`"""
+        counts = self.counts
+
+        @wraps(function)
+        def counted(*args, **kwargs):
+            counts[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def counting(self, name, function=None):
+        """
+        Return a function that counts its calls in the counter `name`, from
+        any thread, and then calls `function` with its arguments, if given.
+        """
+        def counting(*args, **kwargs):
+            self.add(name)
+            if function is not None:
+                function(*args, **kwargs)
+        return counting
+
+    def as_dict(self):
+        """Return the counters and the seconds spent in each phase"""
+        return OrderedDict([
+            ('counts', OrderedDict(self.counts)),
+            ('seconds', OrderedDict((name, ns / 1e9) for name, ns in self.times_ns.items())),
+        ])
+
+    def format(self):
+        """Return the counters and times as a table, for printing"""
+        lines = ['{:<20} {:>12}'.format(name, count) for name, count in self.counts.items()]
+        lines.append('')
+        for name, ns in self.times_ns.items():
+            label = '  ' * PHASES[name] + name
+            lines.append('{:<20} {:>10.3f} s'.format(label, ns / 1e9))
+        return '\n'.join(lines)
@@ -0,0 +1,51 @@
+from __future__ import print_function
+
+import os
+
+import pytest
+
+# the benchmarks are not installed with pysorter, only found in a checkout
+pytest.importorskip('benchmarks')
+
+from benchmarks import cases, tree  # noqa: E402
+
+
+def listing(root):
+    return sorted(os.path.relpath(os.path.join(base, name), root)
+                  for base, dirs, files in os.walk(root) for name in dirs + files)
+
+
+def test_generated_tree_is_reproducible(tempdir):
+    options = dict(files=300, depth=2, fanout=3, seed=7, collisions=0.2, empty_dirs=0.5)
+    paths = tree.generate_tree(tempdir.getpath('a'), **options)
+    assert paths == tree.generate_tree(tempdir.getpath('b'), **options)
+
+    assert listing(tempdir.getpath('a')) == listing(tempdir.getpath('b'))
+    assert len(listing(tempdir.getpath('a'))) + 1 == paths
+    assert sum(name.startswith('common') for name in os.listdir(tempdir.getpath('a'))) > 0
+
+    options['seed'] = 8
+    tree.generate_tree(tempdir.getpath('c'), **options)
+    assert listing(tempdir.getpath('a')) != listing(tempdir.getpath('c'))
+
+
+def test_rule_extensions():
+    extensions = tree.rule_extensions()
+    assert extensions[:2] == ['.a2w', '.gz']
+    assert len(extensions) == len(set(extensions))
+
+
+def test_run_case(tempdir):
+    options = dict(files=50, depth=1, fanout=2)
+    paths = tree.generate_tree(tempdir.getpath('tree'), **options)
+
+    result = cases.run_case('dry-run', cases.DEFAULT_RULES, tempdir.getpath('tree'), paths,
+                            tempdir.getpath('scratch'), options)
+    assert result['paths'] == paths
+    assert result['seconds'] > 0
+
+    tempdir.makedir('scratch')
+    result = cases.run_case('in-place', cases.DEFAULT_RULES, None, None,
+                            tempdir.getpath('scratch'), options)
+    assert result['paths'] == paths
+    assert 'src' in os.listdir(tempdir.getpath('scratch'))
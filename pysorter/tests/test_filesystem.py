@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import os
+
 import pytest
 
 from .. import filesystem
@@ -27,3 +29,94 @@ def test_makepath_file(tempdir):
 def test_paths_to_tree_bad():
     with pytest.raises(ValueError):
         filesystem.paths_to_tree(['hello/world', 'hello/world/afile'])
+
+def test_scan_tree_order_skip_and_prune(tempdir):
+    for path in ['b.txt', 'a/x.txt', 'a/deep/y.txt', 'c/z.txt', 'c/skipped.txt', 'd/w.txt']:
+        tempdir.write(path, b'')
+
+    walked = []
+    prune = {'d/'}
+    tree = filesystem.scan_tree('.', skip={'c/': {'skipped.txt'}}, prune=prune)
+    for path, entry in tree:
+        walked.append(path)
+        assert entry.is_dir() == path.endswith('/')
+        if path == 'c/':
+            prune.add('a/deep/')
+
+    assert sorted(walked) == ['a/', 'a/deep/', 'a/x.txt', 'b.txt', 'c/', 'c/z.txt', 'd/']
+    # files before directories, and a whole directory before its children
+    assert walked[0] == 'b.txt'
+    assert set(walked[1:4]) == {'a/', 'c/', 'd/'}
+
+    walked = [path for path, _ in filesystem.scan_tree('.', recurse=False)]
+    assert sorted(walked) == ['a/', 'b.txt', 'c/', 'd/']
+
+
+@pytest.mark.parametrize('renameat2', [True, False])
+def test_moves_do_not_replace(tempdir, monkeypatch, renameat2):
+    if not renameat2:
+        monkeypatch.setattr(filesystem, '_renameat2', None)
+    elif filesystem._renameat2 is None:
+        pytest.skip("renameat2 is not available")
+
+    tempdir.write('a', b'new')
+    tempdir.write('b', b'old')
+    tempdir.makedir('c')
+    tempdir.makedir('d')
+
+    with pytest.raises(FileExistsError):
+        filesystem.move_file('a', 'b')
+    with pytest.raises(FileExistsError):
+        filesystem.move_dir('c', 'd')
+    assert tempdir.read('b') == b'old'
+
+    filesystem.move_file('a', 'e')
+    tempdir.compare(['b', 'c/', 'd/', 'e'])
+
+
+def test_directory_index(tempdir):
+    tempdir.write('dir/a', b'')
+    tempdir.makedir('dir/sub')
+    index = filesystem.DirectoryIndex()
+
+    assert index.exists(tempdir.getpath('dir/a'))
+    assert index.exists(tempdir.getpath('dir/sub/'))
+    assert not index.exists(tempdir.getpath('dir/b'))
+    assert not index.exists(tempdir.getpath('missing/a'))
+
+    # read once
+    tempdir.write('dir/b', b'')
+    assert not index.exists(tempdir.getpath('dir/b'))
+
+
+@pytest.mark.parametrize('in_kernel', [True, False])
+def test_cross_device_copier(tempdir, monkeypatch, in_kernel):
+    if not in_kernel:
+        monkeypatch.setattr(filesystem, '_copy_file_range', None)
+
+    data = bytes(range(256)) * 40
+    src = tempdir.write('big', data)
+    os.utime(src, (1000000000, 1000000000))
+    tempdir.write('taken', b'')
+
+    copier = filesystem.CrossDeviceCopier(chunk_size=1000, jobs=3)
+    with pytest.raises(FileExistsError):
+        copier.move(src, tempdir.getpath('taken'))
+
+    copier.move(src, tempdir.getpath('moved'))
+    copier.close()
+
+    tempdir.compare(['moved', 'taken'])
+    assert tempdir.read('moved') == data
+    assert os.stat(tempdir.getpath('moved')).st_mtime == 1000000000
+    assert copier.bytes_copied == len(data)
+
+
+def test_remove_empty_dirs(tempdir):
+    for path in ['a/b/c/', 'a/d/', 'e/f/', 'g/']:
+        tempdir.makedir(path)
+    tempdir.write('e/file', b'')
+    os.symlink(tempdir.getpath('g'), tempdir.getpath('e/link'))
+
+    filesystem.remove_empty_dirs(tempdir.path)
+    tempdir.compare(['e/', 'e/file', 'e/link'])
@@ -0,0 +1,32 @@
+from __future__ import print_function
+
+import io
+
+import pytest
+
+from .. import plan
+
+
+def test_plan_round_trip():
+    moves = plan.MovePlan('/src', '/dst')
+    moves.add('b.pdf', '/dst/docs/b.pdf', plan.FILE)
+    moves.add('a.mp3', '/dst/music/a.mp3', plan.FILE)
+    moves.add('photos/', '/elsewhere/photos', plan.DIRECTORY)
+    moves.add('c.pdf', '/dst/docs/b.pdf', plan.FILE)
+
+    assert moves.destinations[:2] == ['docs/b.pdf', 'music/a.mp3']
+    assert moves.has_destination('/dst/music/a.mp3')
+    assert moves.destination_dirs() == {'/dst/docs', '/dst/music', '/elsewhere'}
+
+    assert [src for src, _, _ in moves.subset([2, 0])] == ['/src/photos/', '/src/b.pdf']
+
+    f = io.StringIO()
+    moves.dump(f)
+    f.seek(0)
+    loaded = plan.MovePlan.parse(f)
+    assert list(loaded) == list(moves)
+
+
+def test_not_a_plan():
+    with pytest.raises(ValueError):
+        plan.MovePlan.parse(io.StringIO('["a", "b", "f"]\n'))
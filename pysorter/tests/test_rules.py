@@ -1,6 +1,11 @@
 
 from __future__ import print_function
 
+import json
+import os
+import pickle
+import re
+
 import pytest
 
 from .. import rules
@@ -16,3 +21,190 @@ def test_bad_rule(tempdir):
     with pytest.raises(ValueError) as excinfo:
         rules.RulesFileClassifier.load_file('filetypes.py')
     assert 'unhandled type in rule list' in str(excinfo.value).lower()
+
+def test_suffix_rules_are_indexed():
+    classifier = rules.RulesFileClassifier([
+        (r'\.(?i)pdf$', rules.make_constant_function('pdf/')),
+        (r'.*\.tar\.gz$', rules.make_constant_function('tarballs/')),
+        (r'\.gz$', rules.make_constant_function('gzip/')),
+    ])
+    assert not classifier.scanned
+    assert classifier('docs/report.PDF') == 'pdf/'
+    assert classifier('backup.tar.gz') == 'tarballs/'
+    assert classifier('backup.gz') == 'gzip/'
+    with pytest.raises(rules.Unhandled):
+        classifier('backup.GZ')
+
+def test_suffix_index_keeps_rule_order():
+    classifier = rules.RulesFileClassifier([
+        (r'^keep/', rules.make_constant_function(rules.Skip)),
+        (r'\.pdf$', rules.make_constant_function('pdf/')),
+        (r'.*', rules.make_constant_function('other/')),
+    ])
+    assert len(classifier.scanned) == 2
+    assert classifier('keep/report.pdf') is rules.Skip
+    assert classifier('report.pdf') == 'pdf/'
+    assert classifier('report.doc') == 'other/'
+
+def test_prefilter_keeps_first_match():
+    def callback(match, path):
+        return match.group(0) + '/'
+
+    rule_list = [
+        (r'(?i)^Camera\d+/', rules.make_constant_function('camera/')),
+        (r'c+x', callback),
+        (r'(?P<name>x)y', rules.make_regex_rule_function(re.compile('(?P<name>x)y'), '{name}/')),
+        (r'b|y', rules.make_constant_function(rules.Skip)),
+    ]
+    scan = rules.RulesFileClassifier(rule_list)
+    prefiltered = rules.RulesFileClassifier(rule_list, prefilter=True)
+
+    assert [_[3] for _ in prefiltered.scanned] == [('camera', True), ('c', False), ('y', False), None]
+    for path in ['CAMERA12/a.jpg', 'ccxy', 'xy', 'ab', 'z']:
+        try:
+            expected = scan(path)
+        except rules.Unhandled:
+            expected = rules.Unhandled
+        try:
+            assert prefiltered(path) == expected
+        except rules.Unhandled:
+            assert expected is rules.Unhandled
+
+def test_cache_only_stores_extension_rules():
+    def callback(match, path):
+        return path + '/'
+
+    classifier = rules.RulesFileClassifier([
+        (r'\.(?i)jpg$', rules.make_constant_function('images/')),
+        (r'\.tar\.gz$', rules.make_constant_function(rules.Skip)),
+        (r'\.txt$', callback),
+    ])
+    cached = rules.CachingClassifier(classifier, maxsize=2)
+    assert classifier.extension_rules == 2
+
+    assert cached('a/one.jpg') == 'images/'
+    assert cached('b/two.JPG') == 'images/'
+    assert cached('three.jpg') == 'images/'
+    assert cached('x.tar.gz') is rules.Skip
+    assert cached('y.tar.gz') is rules.Skip
+    assert cached('notes.txt') == 'notes.txt/'
+    assert cached('other.txt') == 'other.txt/'
+    assert cached('noextension') is rules.Unhandled
+
+    info = cached.info()
+    assert (info.hits, info.misses, info.currsize) == (2, 6, 2)
+
+def test_destination_placeholders_checked_when_loaded():
+    pattern = re.compile(r'(?P<year>\d{4})-(\d{2})')
+    for dstfmt in ['{3}/', '{month}/', '{}/{1}/', 'images}/']:
+        with pytest.raises(ValueError):
+            rules.make_regex_rule_function(pattern, dstfmt)
+
+    function = rules.make_regex_rule_function(pattern, 'images/{year}/{2}/{0!r}')
+    assert function(pattern.search('2016-03-12.jpg'), '2016-03-12.jpg') == "images/2016/03/'2016-03'"
+
+    constant = rules.make_regex_rule_function(pattern, 'images/{{raw}}/')
+    assert rules.is_constant(constant)
+    assert constant(None, 'any') == 'images/{raw}/'
+
+def test_profiling_counts_rules(tempdir):
+    tempdir.write('filetypes.py', "RULES = [(r'\\.pdf$', 'docs/'), (r'^(\\d+)-', 'dated/{1}/'),"
+                                  " (r'\\.never$', 'never/'), (r'^[^/]+$', 'other/')]", 'utf-8')
+    classifier = rules.ProfilingClassifier.load_file('filetypes.py')
+    assert classifier('a.pdf') == 'docs/'
+    assert classifier('2016-a.txt') == 'dated/2016/'
+    assert classifier('notes') == 'other/'
+
+    profile = dict((row['rule'], row) for row in classifier.profile())
+    assert [(profile[i]['attempts'], profile[i]['hits']) for i in range(4)] == [
+        (1, 1), (2, 1), (0, 0), (1, 1)
+    ]
+    assert profile[1]['seconds'] > 0
+    assert classifier.index_lookups == 3
+
+    assert json.loads(classifier.profile_json())['rules'][0]['seconds'] > 0
+    table = classifier.format_profile(limit=2)
+    assert len(table.splitlines()) == 1 + 2 + 2
+    assert table.endswith('1 of 4 rules never matched')
+
+def test_required_suffixes_disjoint():
+    suffix = lambda pattern: rules.required_suffix(re.compile(pattern))
+    assert rules.suffixes_disjoint(suffix(r'^(\d+)-.*\.jpg$'), suffix(r'(.+)\.mp4$'))
+    assert not rules.suffixes_disjoint(suffix(r'(.+)\.tar\.gz$'), suffix(r'(.+)\.gz$'))
+    assert not rules.suffixes_disjoint(suffix(r'(?i)(.+)\.JPG$'), suffix(r'(.+)\.jpg$'))
+    assert not rules.suffixes_disjoint(suffix(r'(.+)\.jpg'), suffix(r'(.+)\.mp4$'))
+    assert suffix(r'a+$') == ('a', False)
+    assert suffix(r'\.jpg\Z') == ('.jpg', False)
+    assert suffix(r'\.jpg\$') is None
+
+def test_reorder_keeps_first_match(tempdir):
+    tempdir.write('filetypes.py', "RULES = ["
+                                  "(r'^(\\w+)\\.txt$', 'text/{1}/'),"
+                                  "(r'^(\\w+)/', 'dirs/{1}/'),"
+                                  "(r'^(\\w+)\\.jpg$', 'images/{1}/'),"
+                                  "(r'^(\\w+)\\.mp4$', 'videos/{1}/')]", 'utf-8')
+    classifier = rules.AdaptiveClassifier.load_file('filetypes.py')
+    paths = ['a.jpg', 'b.jpg', 'c.jpg', 'd.mp4', 'e.mp4', 'f.txt', 'g/h.jpg']
+    expected = [classifier.classify(path) for path in paths]
+    assert classifier.hits == [1, 1, 3, 2]
+
+    # the .jpg rule may not jump over the rule for directories
+    assert classifier.reorder(classifier.hits) == [0, 1, 2, 3]
+    assert classifier.reorder([1, 0, 3, 4]) == [0, 1, 3, 2]
+    assert [classifier.classify(path) for path in paths] == expected
+
+    with pytest.raises(ValueError):
+        classifier.set_scan_order([2, 0, 1, 3])
+    classifier.set_scan_order([0, 1, 3, 2])
+
+    classifier.hits = [1, 0, 3, 4]
+    classifier.save_order()
+    learned = rules.AdaptiveClassifier.load_file('filetypes.py')
+    assert learned.scan_order() == [0, 1, 3, 2]
+    assert learned.hits == [1, 0, 3, 4]
+    assert [learned.classify(path) for path in paths] == expected
+
+    tempdir.write('filetypes.py', "RULES = [(r'^(\\w+)\\.txt$', 'text/{1}/')]", 'utf-8')
+    assert rules.AdaptiveClassifier.load_file('filetypes.py').hits == [0]
+
+def test_rules_cache(tempdir, monkeypatch):
+    tempdir.write('filetypes.py', "from pysorter import rules\n"
+                                  "def fallback(match, path):\n"
+                                  "    return 'other/{}/'.format(len(path))\n"
+                                  "RULES = [(r'\\.pdf$', 'docs/'), (r'^(\\w+)\\.txt$', 'text/{1}/'),"
+                                  " (r'\\.tmp$', rules.Skip), (r'.*', fallback)]", 'utf-8')
+    paths = ['a.pdf', 'b.txt', 'c.tmp', 'noext']
+    loaded = rules.RulesFileClassifier.load_file('filetypes.py', cache_dir='cache')
+    expected = [loaded.classify(path) for path in paths]
+    assert len(os.listdir('cache')) == 1
+
+    # the rules file is not executed again
+    monkeypatch.setattr(rules, 'exec', lambda *args: pytest.fail('executed'), raising=False)
+    cached = rules.RulesFileClassifier.load_file('filetypes.py', cache_dir='cache')
+    assert [cached.classify(path) for path in paths] == expected
+    assert cached.uses_cwd
+    assert cached.index_state() == loaded.index_state()
+    # nor in the worker processes that classifiers are pickled for
+    unpickled = pickle.loads(pickle.dumps(cached))
+    assert [unpickled.classify(path) for path in paths] == expected
+    monkeypatch.undo()
+
+    tempdir.write('filetypes.py', "RULES = [(r'\\.pdf$', 'pdf/')]", 'utf-8')
+    assert rules.RulesFileClassifier.load_file('filetypes.py', cache_dir='cache')('a.pdf') == 'pdf/'
+
+def test_rules_cache_skips_functions_with_globals(tempdir):
+    tempdir.write('filetypes.py', "import os\n"
+                                  "def base(match, path):\n"
+                                  "    return os.path.basename(path)\n"
+                                  "RULES = [(r'.*', base)]", 'utf-8')
+    rules.RulesFileClassifier.load_file('filetypes.py', cache_dir='cache')
+    assert not os.path.exists('cache')
+
+def test_unwritable_rule_order_is_ignored(tempdir):
+    tempdir.write('filetypes.py', "RULES = [(r'^(\\w+)\\.txt$', 'text/{1}/')]", 'utf-8')
+    tempdir.makedir('filetypes.order.json')
+
+    classifier = rules.AdaptiveClassifier.load_file('filetypes.py')
+    assert classifier('a.txt') == 'text/a/'
+    classifier.save_order()
+    assert os.path.isdir('filetypes.order.json')
@@ -1,9 +1,15 @@
 from __future__ import print_function
 
 import os
+import time
+
+import pytest
 
 from . import helper
 from .. import commandline
+from .. import executors
+from ..journal import Journal
+from ..plan import MovePlan
 
 
 def test_sort_only_filetypes_arg(tempdir):
@@ -343,3 +349,442 @@ def test_skip_recurse_on_file_ok(tempdir):
 
     root_tree = src_tree + [dst_dir, 'filetypes.py', src_dir]
     tempdir.compare(expected=root_tree, path='.')
+
+
+def test_threaded_moves(tempdir):
+    filetypes = {
+        '.*\\.pdf$': 'docs/',
+        '\\.txt$': 'blocked/',
+        '([^/_]*)_([^_]*)\\.(mp3)$': 'music/{1}/{2}.{3}'
+    }
+
+    to_sort = 'source/'
+
+    to_make = ['nested/even/deeper/file.pdf',
+               'awesome_song.mp3',
+               'foo/another_song.mp3',
+               'notes.txt',
+               'blocked'] + ['many/{}.pdf'.format(i) for i in range(50)]
+
+    helper.initialize_dir(tempdir, filetypes, helper.build_path_tree(to_make, to_sort))
+
+    args = [to_sort, '-r', '-c', '-j', '4', '--filetypes', 'filetypes.py']
+    assert commandline.main(args) == 1
+
+    # --- the move into `blocked/` fails, without stopping the others
+    failed = commandline._last_sorter.failed
+    assert [(os.path.relpath(src), os.path.relpath(dst)) for src, dst, _ in failed] == \
+        [('source/notes.txt', 'source/blocked/notes.txt')]
+
+    expected = ['docs/',
+                'docs/file.pdf',
+                'music/',
+                'music/awesome/',
+                'music/awesome/song.mp3',
+                'music/another/',
+                'music/another/song.mp3',
+                'notes.txt',
+                'blocked'] + ['docs/{}.pdf'.format(i) for i in range(50)]
+    tempdir.compare(expected=expected, path=to_sort)
+
+
+def test_parallel_moves_into_a_moved_directory(tempdir, monkeypatch):
+    from .. import filesystem as fs
+
+    # slow file moves down, so that they are still running when `docs/` moves
+    move_file = fs.move_file
+    monkeypatch.setattr(fs, 'move_file', lambda *args, **kwargs: time.sleep(0.002) or move_file(*args, **kwargs))
+
+    filetypes = {r'\.pdf$': 'docs/', r'^docs/$': 'directories/docs'}
+    to_make = ['docs/'] + ['{}.pdf'.format(i) for i in range(40)]
+    helper.initialize_dir(tempdir, filetypes, helper.build_path_tree(to_make, 'src/'))
+
+    assert commandline.main(['src/', '-p', '-j', '4', '-t', 'filetypes.py']) == 0
+    assert commandline._last_sorter.failed == []
+    expected = ['directories/', 'directories/docs/'] + \
+        ['directories/docs/{}.pdf'.format(i) for i in range(40)]
+    tempdir.compare(expected=expected, path='src')
+
+
+def test_process_pool_classification(tempdir):
+    def by_header(match, path):
+        with open(path) as f:
+            return f.read(3) + '/'
+
+    filetypes = {
+        '\\.dat$': by_header
+    }
+
+    to_sort = 'source/'
+
+    helper.initialize_dir(tempdir, filetypes, [to_sort, to_sort + 'other/'])
+    for i in range(40):
+        tempdir.write(to_sort + '{}.dat'.format(i), 'png' if i % 2 else 'gif', 'utf-8')
+    tempdir.write(to_sort + 'other/0.dat', 'jpg', 'utf-8')
+
+    args = [to_sort, '-r', '-p', '--classify-jobs', '2', '--filetypes', 'filetypes.py']
+    commandline.main(args)
+
+    expected = ['gif/', 'png/', 'jpg/', 'jpg/0.dat', 'other/']
+    expected += ['{}/{}.dat'.format('png' if i % 2 else 'gif', i) for i in range(40)]
+    tempdir.compare(expected=expected, path=to_sort)
+    assert commandline._last_sorter.classifiers is None
+
+
+def test_process_pool_is_kept_between_walks(tempdir):
+    from ..oranize import Organizer
+    from ..rules import RulesFileClassifier
+
+    helper.initialize_dir(tempdir, {r'\.pdf$': 'docs/'}, ['src/a/x.pdf', 'src/b/y.pdf'])
+    sorter = Organizer('src', RulesFileClassifier.load_file('filetypes.py'),
+                       do_recurse=True, classify_jobs=2)
+
+    sorter.organize_paths(['a/'])
+    pool = sorter.classifiers
+    sorter.organize_paths(['b/'])
+    assert sorter.classifiers is pool
+    tempdir.compare(expected=['a/', 'b/', 'docs/', 'docs/x.pdf', 'docs/y.pdf'], path='src')
+
+    sorter.close()
+    assert sorter.classifiers is None
+
+
+def test_loaded_classifier_pickles(tempdir):
+    import pickle
+    from .. import rules
+
+    helper.initialize_dir(tempdir, {'\\.pdf$': 'docs/', '(x)': '{1}/'}, [])
+    classifier = rules.CachingClassifier(rules.RulesFileClassifier.load_file('filetypes.py'))
+    copy = pickle.loads(pickle.dumps(classifier))
+    assert copy('a.pdf') == 'docs/'
+    assert copy('x') == 'x/'
+
+
+def test_save_and_apply_plan(tempdir):
+    filetypes = {
+        r'\.pdf$': 'docs/',
+        r'r/$': 'directories/'
+    }
+
+    to_sort = 'src/'
+    to_make = ['story.pdf', 'subdirectory/news.pdf', 'another/notes.txt']
+    src_tree = helper.build_path_tree(to_make, to_sort)
+    helper.initialize_dir(tempdir, filetypes, src_tree)
+
+    args = [to_sort, '-rp', '-t', 'filetypes.py', '--save-plan', 'plan.txt']
+    commandline.main(args)
+    tempdir.compare(expected=src_tree + ['filetypes.py', 'plan.txt', to_sort], path='.')
+
+    commandline.main([to_sort, '-c', '--apply-plan', 'plan.txt'])
+    expected = ['docs/', 'docs/story.pdf', 'docs/news.pdf',
+                'directories/', 'directories/another/', 'directories/another/notes.txt']
+    tempdir.compare(expected=expected, path=to_sort)
+
+
+def test_resume_interrupted_journal(tempdir):
+    filetypes = {
+        r'\.pdf$': 'docs/',
+        r'\.txt$': 'text/',
+    }
+
+    to_sort = 'src/'
+    to_make = ['story.pdf', 'news.pdf', 'notes.txt', 'todo.txt']
+    src_tree = helper.build_path_tree(to_make, to_sort)
+    helper.initialize_dir(tempdir, filetypes, src_tree)
+
+    commandline.main([to_sort, '-t', 'filetypes.py', '--save-plan', 'plan.txt'])
+    plan = MovePlan.load('plan.txt')
+
+    # a run that was killed after completing its first two moves,
+    # of which only the first one was journaled
+    journal = Journal(os.path.abspath('journal.txt'))
+    journal.start(plan)
+    for index in range(2):
+        executors.move(*plan.operation(index))
+    journal.mark_done(0)
+    journal.close()
+
+    args = [to_sort, '-t', 'filetypes.py', '--journal', 'journal.txt']
+    with pytest.raises(RuntimeError):
+        commandline.main(args)
+
+    # the journal only resumes the directory it was made for
+    tempdir.makedir('other')
+    before = sorted(os.listdir(to_sort))
+    with pytest.raises(ValueError):
+        commandline.main(['other', '-t', 'filetypes.py', '--journal', 'journal.txt', '--resume'])
+    assert sorted(os.listdir(to_sort)) == before
+
+    assert commandline.main(args + ['--resume']) == 0
+    expected = ['docs/', 'docs/story.pdf', 'docs/news.pdf',
+                'text/', 'text/notes.txt', 'text/todo.txt']
+    tempdir.compare(expected=expected, path=to_sort)
+    assert journal.read()[1:] == (set([0, 2, 3]), True)
+
+
+def test_state_skips_unchanged_directories(tempdir):
+    filetypes = {
+        r'\.pdf$': 'docs/',
+    }
+
+    to_sort = 'src/'
+    to_make = ['story.pdf', 'sub/news.pdf']
+    src_tree = helper.build_path_tree(to_make, to_sort)
+    helper.initialize_dir(tempdir, filetypes, src_tree)
+
+    def age(*paths):
+        for path in paths:
+            os.utime(path, (0, 0))
+
+    args = [to_sort, '-r', '-t', 'filetypes.py', '-d', 'out', '--state', 'state.db']
+    commandline.main(args)
+    tempdir.compare(expected=['docs/', 'docs/story.pdf', 'docs/news.pdf'], path='out')
+
+    # record the now settled directories
+    age('src', 'src/sub')
+    commandline.main(args)
+    assert commandline._last_sorter.state.skipped == 0
+
+    # a file that appears without changing the mtime of its directory is
+    # not noticed, unlike one that is added to its subdirectory
+    tempdir.write('src/hidden.pdf', b'')
+    age('src')
+    tempdir.write('src/sub/added.pdf', b'')
+    commandline.main(args)
+    assert commandline._last_sorter.state.skipped == 1
+    tempdir.compare(expected=['hidden.pdf', 'sub/'], path=to_sort)
+
+    # changing the rules reads all directories again
+    tempdir.write('filetypes.py', b"RULES = [(r'\\.pdf$', 'pdf/')]\n")
+    commandline.main(args)
+    tempdir.compare(expected=['sub/'], path=to_sort)
+    tempdir.compare(expected=['docs/', 'docs/story.pdf', 'docs/news.pdf', 'docs/added.pdf',
+                              'pdf/', 'pdf/hidden.pdf'], path='out')
+
+
+def test_state_walks_unrecorded_subdirectories(tempdir):
+    helper.initialize_dir(tempdir, {r'\.pdf$': 'docs/'}, ['src/a/c/x.pdf'])
+
+    args = ['src/', '-r', '-t', 'filetypes.py', '-d', 'out', '--state', 'state.db']
+    commandline.main(args)
+
+    # src/a only holds a directory that is not recorded, as it changed lately
+    os.utime('src', (0, 0))
+    os.utime('src/a', (0, 0))
+    commandline.main(args)
+    assert commandline._last_sorter.state.skipped == 0
+
+    tempdir.write('src/a/c/new.pdf', b'')
+    commandline.main(args)
+    assert commandline._last_sorter.state.skipped == 2
+    tempdir.compare(expected=['a/', 'a/c/'], path='src')
+    tempdir.compare(expected=['docs/', 'docs/x.pdf', 'docs/new.pdf'], path='out')
+
+
+def test_destination_directories_are_made_once(tempdir, monkeypatch):
+    from .. import filesystem as fs
+
+    made = []
+    make_path = fs.make_path
+    monkeypatch.setattr(fs, 'make_path', lambda path: made.append(path) or make_path(path))
+
+    filetypes = {r'\.mp3$': 'audio/', r'\.pdf$': 'docs/pdf/'}
+    to_make = ['{}.mp3'.format(i) for i in range(20)] + ['a.pdf', 'b.pdf']
+    helper.initialize_dir(tempdir, filetypes, helper.build_path_tree(to_make, 'src/'))
+
+    commandline.main(['src/', '-t', 'filetypes.py', '-d', 'out'])
+    assert sorted(os.path.relpath(path, tempdir.path) for path in made) == ['out', 'out/audio', 'out/docs/pdf']
+
+
+def test_working_directory_is_left_alone(tempdir, monkeypatch):
+    filetypes = {r'\.pdf$': 'docs/', r'(\w+)\.txt$': 'text/{1}.txt'}
+    to_make = ['a.pdf', 'sub/b.txt']
+    helper.initialize_dir(tempdir, filetypes, helper.build_path_tree(to_make, 'src/'))
+
+    def chdir(path):
+        raise AssertionError("changed directory to {}".format(path))
+
+    monkeypatch.setattr(os, 'chdir', chdir)
+    commandline.main(['src/', '-r', '-t', 'filetypes.py'])
+    tempdir.compare(expected=['docs/', 'docs/a.pdf', 'text/', 'text/b.txt', 'sub/'], path='src')
+
+
+def test_callable_rules_run_in_the_source_directory(tempdir):
+    def in_source(match, path):
+        import os
+        return 'found/' if os.path.isfile(path) else 'missing/'
+
+    helper.initialize_dir(tempdir, {r'\.pdf$': in_source}, helper.build_path_tree(['a.pdf'], 'src/'))
+    commandline.main(['src/', '-t', 'filetypes.py'])
+    tempdir.compare(expected=['found/', 'found/a.pdf'], path='src')
+
+
+def test_indexed_destinations(tempdir):
+    filetypes = {r'\.pdf$': 'docs/'}
+    to_make = ['src/a.pdf', 'src/b.pdf', 'out/docs/a.pdf']
+    helper.initialize_dir(tempdir, filetypes, to_make)
+
+    args = ['src/', '-t', 'filetypes.py', '-d', 'out', '--index-destinations']
+    commandline.main(args + ['-n'])
+    assert os.path.abspath('out/docs') in commandline._last_sorter.destination_index.names
+
+    # real runs leave existing files to the moves, without reading the directories
+    commandline.main(args)
+    assert commandline._last_sorter.destination_index.names == {}
+    tempdir.compare(expected=['a.pdf'], path='src')
+    tempdir.compare(expected=['docs/', 'docs/a.pdf', 'docs/b.pdf'], path='out')
+
+
+@pytest.mark.parametrize('link_mode', ['hardlink', 'symlink', 'reflink'])
+def test_link_modes_leave_the_source(tempdir, link_mode):
+    filetypes = {r'\.pdf$': 'docs/', r'^album/$': 'music/'}
+    to_make = ['story.pdf', 'album/song.mp3']
+    src_tree = helper.build_path_tree(to_make, 'src/')
+    helper.initialize_dir(tempdir, filetypes, src_tree)
+    tempdir.write('src/story.pdf', b'story')
+
+    commandline.main(['src/', '-rp', '-t', 'filetypes.py', '-d', 'out', '--link-mode', link_mode])
+    tempdir.compare(expected=['album/', 'album/song.mp3', 'story.pdf'], path='src')
+    tempdir.compare(expected=['docs/', 'docs/story.pdf', 'music/', 'music/album/', 'music/album/song.mp3'],
+                    path='out', followlinks=True)
+
+    story = tempdir.getpath('out/docs/story.pdf')
+    assert tempdir.read('out/docs/story.pdf') == b'story'
+    assert os.path.islink(story) == (link_mode == 'symlink')
+    assert os.path.samefile(story, tempdir.getpath('src/story.pdf')) == (link_mode != 'reflink')
+
+
+def test_coalesce_directories(tempdir):
+    filetypes = {r'\.jpg$': 'images/jpg/', r'\.txt$': 'text/', r'\.pdf$': 'docs/'}
+    to_make = ['photos/a.jpg', 'photos/b.jpg', 'mixed/c.txt', 'mixed/d.pdf', 'notes/e.txt']
+    helper.initialize_dir(tempdir, filetypes, helper.build_path_tree(to_make, 'src/'))
+
+    commandline.main(['src/', '-rc', '-t', 'filetypes.py', '-d', 'out', '--coalesce-dirs'])
+
+    plan = commandline._last_sorter.move_plan
+    # text/ is the destination of files from two directories
+    assert sorted(zip(plan.sources, plan.kinds)) == [
+        ('mixed/c.txt', 'f'), ('mixed/d.pdf', 'f'), ('notes/e.txt', 'f'), ('photos/', 'd')
+    ]
+    tempdir.compare(expected=[], path='src')
+    tempdir.compare(expected=['docs/', 'docs/d.pdf', 'images/', 'images/jpg/', 'images/jpg/a.jpg',
+                              'images/jpg/b.jpg', 'text/', 'text/c.txt', 'text/e.txt'], path='out')
+
+
+def test_remove_only_emptied(tempdir):
+    to_make = ['src/nested/deeper/file.pdf', 'src/empty/', 'src/kept/moved/other.pdf', 'src/kept/empty/']
+    helper.initialize_dir(tempdir, {r'\.pdf$': 'docs/'}, to_make)
+
+    # a dry run reports the parents that become empty as well
+    commandline.main(['src/', '-rnc', '--only-emptied', '-t', 'filetypes.py'])
+    assert sorted(commandline._last_sorter.dry_rmdir) == [
+        tempdir.getpath(path) for path in ['src/kept/moved', 'src/nested', 'src/nested/deeper']
+    ]
+
+    commandline.main(['src/', '-rc', '--only-emptied', '-t', 'filetypes.py'])
+    tempdir.compare(expected=['docs/', 'docs/file.pdf', 'docs/other.pdf', 'empty/',
+                              'kept/', 'kept/empty/'], path='src')
+
+
+@pytest.mark.parametrize('options', ['-nrc', '-nc', '-nrcp'])
+def test_dry_run_overlay_matches_replay(tempdir, options):
+    from .. import filesystem as fs
+    from ..rules import SkipRecurse
+
+    filetypes = {
+        r'\.pdf$': 'docs/',
+        r'^kept/$': SkipRecurse,
+        r'^old/$': 'archive/',
+        r'\.txt$': 'empty/target/',
+    }
+    to_make = ['a.pdf', 'empty/', 'sub/b.pdf', 'sub/deeper/c.pdf', 'sub/deeper/none/',
+               'kept/d.pdf', 'kept/empty/', 'old/e.txt', 'old/nothing/', 'f.txt', 'g/h/']
+    helper.initialize_dir(tempdir, filetypes, helper.build_path_tree(to_make, 'src/'))
+
+    commandline.main(['src/', options, '-t', 'filetypes.py'])
+    sorter = commandline._last_sorter
+
+    replayed = fs.collect_terminal_empty_dirs(sorter.path_source, sorter.dry_mv_tuples)
+    assert sorted(sorter.dry_rmdir) == sorted(replayed)
+
+
+def test_stats(tempdir, capsys):
+    from ..rules import Skip
+
+    filetypes = {r'\.pdf$': 'docs/', r'\.log$': Skip}
+    to_make = ['src/a.pdf', 'src/b.pdf', 'src/skip.log', 'src/unknown.xyz', 'out/docs/b.pdf']
+    helper.initialize_dir(tempdir, filetypes, to_make)
+
+    commandline.main(['src/', '-t', 'filetypes.py', '-d', 'out', '--stats'])
+    stats = commandline._last_sorter.stats
+    assert dict(stats.counts) == {'seen': 4, 'planned': 2, 'moved': 1, 'skipped': 1,
+                                  'unhandled': 1, 'conflicted': 1, 'failed': 0}
+    assert stats.times_ns['walk'] >= stats.times_ns['classify'] > 0
+    assert stats.as_dict()['seconds']['move'] > 0
+
+    _, err = capsys.readouterr()
+    assert 'conflicted' in err
+    assert '  classify' in err
+
+
+def test_no_stats_leaves_methods_alone(tempdir):
+    helper.initialize_dir(tempdir, {r'\.pdf$': 'docs/'}, ['src/a.pdf'])
+
+    commandline.main(['src/', '-t', 'filetypes.py'])
+    sorter = commandline._last_sorter
+    assert sorter.stats is None
+    assert not set(vars(sorter)) & {'walk', 'process', 'sortrule_destination', 'destination_exists'}
+
+
+def test_profile_rules(tempdir, capsys):
+    import json
+
+    helper.initialize_dir(tempdir, {r'\.pdf$': 'docs/', r'\.txt$': 'text/'}, ['src/a.pdf', 'src/b.pdf'])
+
+    commandline.main(['src/', '-t', 'filetypes.py', '--profile-rules', 'profile.json'])
+    profile = json.loads(tempdir.read('profile.json', 'utf-8'))
+    assert [(row['rule'], row['hits']) for row in profile['rules']][1:] == [(1, 0)]
+    assert profile['rules'][0]['hits'] == 2
+
+    _, err = capsys.readouterr()
+    assert '1 of 2 rules never matched' in err
+
+
+def test_adapt_rules_learns_order(tempdir):
+    to_make = ['src/a.mp4', 'src/b.mp4', 'src/c.jpg']
+    helper.initialize_dir(tempdir, {r'^(\w+)\.jpg$': 'images/{1}/', r'^(\w+)\.mp4$': 'videos/'}, to_make)
+
+    commandline.main(['src/', '-n', '-t', 'filetypes.py', '--adapt-rules'])
+    classifier = commandline._last_sorter.sort_rule.classifier
+    assert classifier.hits == [1, 2]
+    assert classifier.scan_order() == [1, 0]
+    assert tempdir.read('filetypes.order.json')
+
+    with pytest.raises(ValueError):
+        commandline.main(['src/', '-t', 'filetypes.py', '--adapt-rules', '--profile-rules', 'p.json'])
+
+
+def test_rules_cache(tempdir):
+    helper.initialize_dir(tempdir, {r'\.pdf$': 'docs/'}, ['src/a.pdf', 'src/b.pdf'])
+
+    commandline.main(['src/', '-t', 'filetypes.py', '--rules-cache', 'cache', '-n'])
+    assert len(os.listdir(tempdir.getpath('cache'))) == 1
+
+    commandline.main(['src/', '-t', 'filetypes.py', '--rules-cache', 'cache'])
+    tempdir.compare(expected=['docs/', 'docs/a.pdf', 'docs/b.pdf'], path='src')
+
+
+def test_state_is_not_shared_between_link_modes(tempdir):
+    helper.initialize_dir(tempdir, {r'\.pdf$': 'docs/'}, ['src/a.pdf'])
+
+    args = ['src/', '-t', 'filetypes.py', '-d', 'out', '--state', 'state.db']
+    commandline.main(args + ['--link-mode', 'hardlink'])
+    os.utime('src', (0, 0))
+    commandline.main(args + ['--link-mode', 'hardlink'])
+    commandline.main(args + ['--link-mode', 'hardlink'])
+    assert commandline._last_sorter.state.skipped == 1
+
+    os.remove('out/docs/a.pdf')
+    commandline.main(args + ['--link-mode', 'move'])
+    assert commandline._last_sorter.state.skipped == 0
+    tempdir.compare(expected=[], path='src')
@@ -0,0 +1,48 @@
+import os
+import time
+
+import pytest
+
+from . import helper
+from .. import watch
+from ..oranize import Organizer
+from ..rules import RulesFileClassifier
+
+
+def test_debouncer_holds_back_busy_paths():
+    debouncer = watch.Debouncer(quiet=1.0)
+    debouncer.add(['new/', 'a.txt'], now=0)
+    debouncer.add(['new/b.txt'], now=0.5)
+
+    assert debouncer.timeout(0.5, longest=10) == 0.5
+    assert debouncer.ready(1.0) == ['a.txt']
+    # the event within new/ held it back as well
+    assert sorted(debouncer.ready(1.5)) == ['new/', 'new/b.txt']
+    assert debouncer.timeout(1.5, longest=10) == 10
+
+
+@pytest.mark.parametrize('poll_interval', [None, 0.05])
+def test_watch_organizes_new_entries(tempdir, poll_interval):
+    if poll_interval is None and watch._load_libc() is None:
+        pytest.skip("inotify is not available")
+
+    helper.initialize_dir(tempdir, {r'\.pdf$': 'docs/'}, ['src/', 'src/old.pdf'])
+    sorter = Organizer('src', RulesFileClassifier.load_file('filetypes.py'), do_recurse=True)
+
+    steps = iter([
+        lambda: tempdir.write('src/new/story.pdf', b'story'),
+        lambda: tempdir.write('src/notes.pdf', b'notes'),
+    ])
+    deadline = time.monotonic() + 10
+
+    def stop():
+        for step in steps:
+            step()
+            return False
+        done = len(os.listdir(os.path.join(tempdir.path, 'src/docs'))) == 3
+        return done or time.monotonic() > deadline
+
+    watch.watch(sorter, quiet=0.1, poll_interval=poll_interval, stop=stop, tick=0.05)
+
+    tempdir.compare(expected=['docs/', 'docs/old.pdf', 'docs/notes.pdf', 'docs/story.pdf',
+                              'new/'], path='src')
@@ -0,0 +1,327 @@
+"""
+    Keeps organizing a directory as entries are added to it, driven by
+    inotify on Linux, or by polling elsewhere
+"""
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from . import filesystem as fs
+
+log = logging.getLogger(__name__)
+
+# see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_EVENT = struct.Struct('iIII')
+
+# the path that stands for the whole directory, when events were lost
+RESCAN = ''
+
+
+def _load_libc():
+    """Return libc with the inotify functions, or None if it has none"""
+    name = ctypes.util.find_library('c')
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        functions = libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+
+    init, add_watch, rm_watch = functions
+    init.argtypes = [ctypes.c_int]
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def _check(result):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+
+class InotifyWatcher(object):
+    """
+    Reports the canonical paths, relative to `top`, of entries that were
+    created, written to, or moved into `top`, or any of its subdirectories
+    when `recurse` is set. Directories are watched as they appear.
+    """
+
+    def __init__(self, top, recurse=False, skip=None, libc=None):
+        super().__init__()
+        self.libc = libc or _load_libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.top = top
+        self.recurse = recurse
+        self.skip = skip or {}
+
+        self.fd = _check(self.libc.inotify_init1(IN_CLOEXEC))
+        # watch descriptor --> canonical directory path
+        self.watches = {}
+        try:
+            self.add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, path):
+        """
+        Watch the canonical directory `path`, and return whether it is. Raises
+        OSError when the limit on the number of watches is reached.
+        """
+        target = os.path.join(self.top, path).encode()
+        try:
+            wd = _check(self.libc.inotify_add_watch(self.fd, target, WATCH_MASK))
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+            # gone already, or not a directory
+            return False
+        self.watches[wd] = path
+        return True
+
+    def add_tree(self, path):
+        """Watch the canonical directory `path` and, when recursing, its subdirectories"""
+        if self.add_watch(path) and self.recurse:
+            for sub, _ in fs.scan_tree(self.top, skip=self.skip, start=path):
+                if not fs.is_file(sub):
+                    self.add_watch(sub)
+
+    def wait(self, timeout):
+        """
+        Return the paths of entries that changed, waiting at most `timeout`
+        seconds for the first one.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                log.warning("Missed filesystem events, walking the whole directory")
+                paths.append(RESCAN)
+                continue
+
+            base = self.watches.get(wd)
+            if base is None:
+                continue
+
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # it is watched again under its new path, if that is within `top`
+                if not mask & IN_IGNORED:
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                self.watches.pop(wd, None)
+                continue
+
+            if not name or name in self.skip.get(base, ()):
+                continue
+
+            if mask & IN_ISDIR:
+                # only new directories are of interest, their entries
+                # are reported separately
+                if not mask & (IN_CREATE | IN_MOVED_TO):
+                    continue
+                path = base + name + '/'
+                if self.recurse:
+                    try:
+                        self.add_tree(path)
+                    except OSError as e:
+                        log.warning("Cannot watch %s: %s", path, e)
+            else:
+                path = base + name
+            paths.append(path)
+
+        return paths
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PollingWatcher(object):
+    """
+    Reports the same paths as InotifyWatcher, by comparing the sizes and
+    mtimes of all entries every `interval` seconds.
+    """
+
+    def __init__(self, top, recurse=False, skip=None, interval=5.0):
+        super().__init__()
+        self.top = top
+        self.recurse = recurse
+        self.skip = skip or {}
+        self.interval = interval
+
+        self.entries = self.snapshot()
+        self.next_poll = time.monotonic() + interval
+
+    def snapshot(self):
+        entries = {}
+        for path, entry in fs.scan_tree(self.top, skip=self.skip, recurse=self.recurse):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            entries[path] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return entries
+
+    def wait(self, timeout):
+        delay = self.next_poll - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(delay, 0))
+
+        entries = self.snapshot()
+        self.next_poll = time.monotonic() + self.interval
+        old, self.entries = self.entries, entries
+        # directories change with their entries, only new ones are reported
+        return [path for path, key in entries.items()
+                if old.get(path) != key and (fs.is_file(path) or path not in old)]
+
+    def close(self):
+        pass
+
+
+def open_watcher(top, recurse=False, skip=None, poll_interval=None):
+    """
+    Return an InotifyWatcher for `top`, or a PollingWatcher if inotify
+    is not available or `poll_interval` is given.
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(top, recurse=recurse, skip=skip)
+        except OSError as e:
+            log.warning("Cannot watch with inotify, polling instead: %s", e)
+            poll_interval = 5.0
+    return PollingWatcher(top, recurse=recurse, skip=skip, interval=poll_interval)
+
+
+class Debouncer(object):
+    """
+    Holds back paths until no events arrived for them for `quiet` seconds,
+    so that files are not organized while they are still being written.
+    Events for entries within a held back directory hold it back as well.
+    """
+
+    def __init__(self, quiet):
+        super().__init__()
+        self.quiet = quiet
+        # path --> time of its last event
+        self.last_event = {}
+
+    def add(self, paths, now):
+        last_event = self.last_event
+        for path in paths:
+            last_event[path] = now
+            parent = path.rstrip('/')
+            while '/' in parent:
+                parent = parent[:parent.rfind('/')]
+                if parent + '/' in last_event:
+                    last_event[parent + '/'] = now
+
+    def ready(self, now):
+        """Remove and return the paths that have been quiet long enough"""
+        ready = [path for path, last in self.last_event.items() if now - last >= self.quiet]
+        for path in ready:
+            del self.last_event[path]
+        return ready
+
+    def timeout(self, now, longest):
+        """Return how long to wait for events before some path could be ready"""
+        if not self.last_event:
+            return longest
+        return max(0, min(longest, min(self.last_event.values()) + self.quiet - now))
+
+
+def watch(sorter, quiet=2.0, poll_interval=None, stop=None, tick=1.0):
+    """
+    Organize the source directory of `sorter`, then keep organizing the
+    entries that are added to it, until `stop` returns True or the
+    process is interrupted.
+
+    Parameters
+    ----------
+    sorter: Organizer
+        organizes the paths that changed, with the rules already loaded
+
+    quiet: float
+        seconds without events before an entry is organized
+
+    poll_interval: float
+        poll every `poll_interval` seconds instead of using inotify
+
+    stop: function() --> bool
+        checked at least every `tick` seconds
+    """
+    watcher = open_watcher(sorter.path_source, recurse=sorter.do_recurse,
+                           skip=sorter.skip_map(), poll_interval=poll_interval)
+    debouncer = Debouncer(quiet)
+    stop = stop or (lambda: False)
+
+    def moved_in(plan):
+        """the paths within the source that `plan` moved entries to or created"""
+        prefix = os.path.join(sorter.path_source, '')
+        paths = set()
+        for dst in plan.taken:
+            path = dst[len(prefix):] if dst.startswith(prefix) else ''
+            while path and path not in paths:
+                paths.add(path)
+                path = os.path.dirname(path)
+        return paths
+
+    try:
+        sorter.organize()
+        # the events caused by organizing are of no interest
+        ignore = moved_in(sorter.move_plan)
+
+        while not stop():
+            timeout = debouncer.timeout(time.monotonic(), tick)
+            paths = watcher.wait(timeout)
+            debouncer.add((path for path in paths if path.rstrip('/') not in ignore),
+                          time.monotonic())
+
+            ready = debouncer.ready(time.monotonic())
+            if ready:
+                log.debug("Organizing %d changed paths", len(ready))
+                sorter.organize_paths(ready)
+                ignore = moved_in(sorter.move_plan)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        sorter.close()
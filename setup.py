@@ -17,7 +17,7 @@ setup(
     author='Chris Coetzee',
     author_email='chriscz93@gmail.com',
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     setup_requires=['pytest-runner'],
     tests_require=tests_require,
 